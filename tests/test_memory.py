@@ -0,0 +1,30 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+pytest.importorskip('project_common.mqtt')
+
+from thermostat import memory
+
+
+# Low-memory budget for the daemon, in MiB.
+RSS_TARGET = 40
+
+
+def test_soak_stays_under_rss_target():
+    # A process of its own, as low-memory mode sets the stack size process wide.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory,'soak.json')
+        result = subprocess.run([sys.executable,'-m','thermostat.soak','--hours','3','--rss-target',str(RSS_TARGET),'--report',path],
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),capture_output=True,text=True,timeout=120)
+        assert result.returncode == 0, result.stdout + result.stderr
+        with open(path,'r') as f:
+            report = json.load(f)
+
+    assert report['failures'] == []
+    assert max(s['rss'] for s in report['samples']) < RSS_TARGET * memory.MIB
+    assert report['stack_size'] == memory.THREAD_STACK_SIZE
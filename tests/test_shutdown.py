@@ -0,0 +1,126 @@
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('project_common.mqtt')
+
+from project_common.mqtt import Mqtt
+
+from thermostat import relays
+from thermostat import sht3x
+from thermostat.config import Config
+from thermostat.control import Control
+from thermostat.publisher import Publisher
+from thermostat.scheduler import Scheduler
+
+
+# Shutdown budget the daemon is held to, and given as its stop timeout.
+SHUTDOWN_TARGET = 0.1
+
+
+class StillSht3x():
+    def start(self):
+        pass
+
+
+    def stop(self, timeout: float = None):
+        pass
+
+
+    def set_samples(self, samples: int):
+        pass
+
+
+    def counts(self) -> tuple:
+        return (sht3x.celsius_to_counts(21.0), 1)
+
+
+    def humidity(self) -> float:
+        return 45.0
+
+
+    def window(self) -> list:
+        return []
+
+
+    def restore(self, window: list, humidity: float, oldest: float) -> int:
+        return 0
+
+
+class IdleFan():
+    def on(self):
+        pass
+
+
+    def off(self, timeout: float = None):
+        pass
+
+
+    def set_pwm_duty(self, duty: int):
+        pass
+
+
+    def get_rpm(self) -> int:
+        return None
+
+
+@pytest.fixture
+def held(monkeypatch):
+    # The relay board is a FIFO nothing writes to, so a tick's status read
+    # blocks on the bus fd the way a wedged I2C transfer does.
+    monkeypatch.setattr(relays.fcntl,'ioctl',lambda fd, request, arg: 0)
+    with tempfile.TemporaryDirectory() as directory:
+        device = os.path.join(directory,'i2c')
+        os.mkfifo(device)
+        Config({'thermostat': {
+            'sht3x-device': 'test',
+            'i2c-device': 'test',
+            'relay-address': 0x10,
+            'fan-pwr-gpio': 'test',
+            'settings-file': os.path.join(directory,'settings.json'),
+            'shutdown-timeout': SHUTDOWN_TARGET,
+        }})
+        Mqtt({'mqtt': {'clientid': 'thermostat-test'}})
+        Publisher()
+        Scheduler()
+
+        relay = relays.Relays(os.path.relpath(device,'/dev'),0x10)
+        ctl = Control(sht=StillSht3x(),relay=relay,board_fan=IdleFan())
+        ctl.open()
+        try:
+            yield (ctl, device)
+        finally:
+            Scheduler.instance().stop()
+            Publisher.instance().stop()
+
+
+def test_stop_forces_relays_off_within_target(held):
+    (ctl, device) = held
+    tick = threading.Thread(target=ctl.tick,daemon=True)
+    tick.start()
+    time.sleep(0.05)
+    assert tick.is_alive()
+
+    # The stuck read keeps the FIFO; the forced all-off opens the path anew.
+    os.rename(device,device + '.held')
+    open(device,'wb').close()
+
+    # On a thread of its own, so a stop that waits on the bus fails rather than hangs.
+    stop = threading.Thread(target=ctl.stop,args=(Config.instance().shutdown_timeout(),),daemon=True)
+    time_in = time.monotonic()
+    stop.start()
+    stop.join(1.0)
+    elapsed = time.monotonic() - time_in
+    assert not stop.is_alive()
+
+    with open(device,'rb') as f:
+        assert f.read() == b'\x00\x01\x01\x01'
+    assert elapsed < SHUTDOWN_TARGET
+
+    # Let the stuck read return so the tick can finish.
+    with open(device + '.held','wb') as f:
+        f.write(bytes(4))
+    tick.join(1.0)
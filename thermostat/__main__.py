@@ -6,51 +6,177 @@ import time
 
 from project_common import cli
 from project_common import logger
-from project_common.mqtt import Mqtt
 
-from .control import Control
+from . import config
+from . import memory
+from . import startup
 from .config import Config
-from .settings import Settings
 
-__signal = threading.Event()
 
-clconfig = cli.parse_command_line_arguments()
+# Taken off the command line before it is parsed; neither is configuration.
+CHECK_CONFIG = '--check-config'
+PROFILE_STARTUP = '--profile-startup'
 
-Config(clconfig)
+# Everything the daemon needs beyond the configuration, in dependency order so
+# each import is profiled on its own. None of it is loaded by --check-config.
+MODULES = ('project_common.mqtt', '.metrics', '.scheduler', '.publisher', '.sht3x', '.relays', '.fan', '.control', '.schedule', '.settings', '.query')
 
-# Parse the logger configuration ahead of any other import
-# in case a module also modifies the logger
-logger.parse_logger_config(Config.instance().logger_config(),appname='thermostat')
+__signal = threading.Event()
+__hangup = threading.Event()
+__wake = threading.Event()
 
 
-def __signal_handler(signal, frame):
+def __signal_handler(signum, frame):
     try:
-        logger.logger.info(f"Caught signal {signal}")
-        __signal.set()
+        logger.logger.info(f"Caught signal {signum}")
+        if signum == signal.SIGHUP:
+            __hangup.set()
+        else:
+            __signal.set()
+        __wake.set()
     except:
         sys.exit(-1)
 
 
-if __name__ == '__main__':
+def __configure_logger():
+    logger.parse_logger_config(Config.instance().logger_config(),appname='thermostat')
+
+
+def __reload():
+    """Re-read the configuration; runtime state (filter window, relays, MQTT session) is kept."""
+    logger.logger.info('Reloading configuration')
+    try:
+        restart = Config.instance().reload(cli.parse_command_line_arguments())
+    except Exception as ex:
+        logger.logger.error(f'Configuration not reloaded: {ex}')
+        return
+
+    for name in restart:
+        logger.logger.warning(f'Change to {name.replace("_","-")} requires a restart to take effect.')
+
+
+def __check_config() -> int:
+    """Parse and validate the configuration, without loading any of the device drivers."""
+    try:
+        Config(cli.parse_command_line_arguments())
+    except Exception as ex:
+        print(f'Configuration is not valid: {ex}',file=sys.stderr)
+        return 1
+
+    for zone in Config.instance().zones():
+        print(f'{zone.topic()}: sensor {zone.sht3x_device()} ({zone.sht3x_mode()}), relays {zone.i2c_device()}@{zone.i2c_relay_addr()}, settings {zone.settings_file()}')
+    print('Configuration is valid.')
+    return 0
+
+
+def main() -> int:
+    flags = {arg for arg in sys.argv[1:] if arg in (CHECK_CONFIG, PROFILE_STARTUP)}
+    sys.argv = [arg for arg in sys.argv if not arg in flags]
+
+    if CHECK_CONFIG in flags:
+        return __check_config()
+    if PROFILE_STARTUP in flags:
+        startup.enable()
+
+    with startup.step('config'):
+        Config(cli.parse_command_line_arguments())
+
+        # Parse the logger configuration ahead of any other import
+        # in case a module also modifies the logger
+        __configure_logger()
+        # Registered first so on a reload the other callbacks see the new log level.
+        Config.instance().register_on_reload(__configure_logger)
+
     logger.logger.info('thermostat is starting')
 
+    if Config.instance().low_memory():
+        # Before the first thread, which the MQTT client starts.
+        memory.limit_stacks()
+
+    startup.load(__package__,MODULES)
+    from project_common.mqtt import Mqtt
+    from .control import Control
+    from .metrics import Metrics
+    from .publisher import Publisher
+    from .query import Query
+    from .scheduler import Scheduler
+    from .settings import Settings
+
+    with startup.step('mqtt'):
+        Mqtt({'mqtt': {'clientid': 'thermostat'}})
+    Publisher()
+
+    # Only the port at startup counts; a reload cannot move or remove the endpoint.
+    metrics_server = None
+    if not Config.instance().metrics_port() is None:
+        metrics_server = Metrics(Config.instance().metrics_port())
+
+    if Config.instance().runtime() == config.RUNTIME_ASYNCIO:
+        with startup.step('import .runtime'):
+            from .runtime import Runtime
+        Runtime(__reload).run()
+        if not metrics_server is None:
+            metrics_server.stop()
+        return 0
+
     signal.signal(signal.SIGINT, __signal_handler)
     signal.signal(signal.SIGHUP, __signal_handler)
 
-    Mqtt({'mqtt': {'clientid': 'thermostat'}})
-    Control()
-    Settings()
+    Scheduler()
+    for zone in Config.instance().zones():
+        with startup.step('zone' if zone.zone() is None else f'zone/{zone.zone()}'):
+            Control(zone)
+            Settings(zone)
+    startup.log_first_status(Publisher.instance(),[zone.topic() for zone in Config.instance().zones()])
 
-    Mqtt.instance().connect()
+    # Every zone has registered its callbacks and set the will, so the broker
+    # connection can come up while the hardware does.
+    connect = startup.Background('connect',Mqtt.instance().connect)
+    for control in Control.instances():
+        control.open()
+
+    query_server = None
+    if not Config.instance().query_socket() is None:
+        query_server = Query(Config.instance().query_socket())
+
+    for control in Control.instances():
+        control.start()
+    connect.join()
 
     logger.logger.info('thermostat is started')
+    startup.report()
+    memory.report(Config.instance().rss_target())
 
     while not __signal.is_set():
-        time.sleep(0.250)
+        __wake.wait()
+        __wake.clear()
+        if __hangup.is_set():
+            __hangup.clear()
+            __reload()
 
     logger.logger.info('thermostat is stopping')
 
-    Control.instance().stop()
+    # Everything gets a share of one deadline; the relays are forced off even if it is missed.
+    time_in = time.monotonic()
+    deadline = time_in + Config.instance().shutdown_timeout()
+
+    if not query_server is None:
+        query_server.stop()
+    for settings in Settings.instances():
+        settings.stop()
+    Scheduler.instance().stop(max(deadline - time.monotonic(),0.0))
+    for control in Control.instances():
+        control.stop(max(deadline - time.monotonic(),0.0))
+    # Out-of-service and any final replies go out before the connection closes.
+    Publisher.instance().stop(max(deadline - time.monotonic(),0.0))
     Mqtt.instance().disconnect()
 
-    logger.logger.info('thermostat is stopped')
+    if not metrics_server is None:
+        metrics_server.stop()
+
+    logger.logger.info(f'thermostat is stopped in {time.monotonic() - time_in:1.3f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""Microbenchmarks for the daemon's hot paths, runnable without hardware.
+
+    python -m thermostat.bench [--output results.json] [--compare baseline.json]
+
+Results are written as JSON so runs from different revisions can be
+compared; --compare exits non-zero when a case got slower than --threshold.
+Logging is silenced so the results measure the code rather than the log sink.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from project_common.logger import logger
+from project_common.mqtt import Mqtt
+
+from . import control
+from . import relays
+from . import sht3x
+from .config import Config
+from .control import Control
+from .fan import Fan
+from .publisher import Publisher
+from .scheduler import Scheduler
+from .settings import Settings
+
+
+SAMPLE_SIZES = (10, 150, 600)
+REPEAT = 7
+MIN_ROUND_TIME = 0.05
+THRESHOLD = 0.10
+
+
+class FakeSht3x():
+    """Cycles through temperatures either side of the setpoints so every tick makes a decision."""
+    def __init__(self, temperatures: list):
+        self.__temperatures = temperatures
+        self.__i = 0
+
+
+    def start(self):
+        pass
+
+
+    def stop(self, timeout: float = None):
+        pass
+
+
+    def set_samples(self, samples: int):
+        pass
+
+
+    def counts(self) -> tuple:
+        self.__i = (self.__i + 1) % len(self.__temperatures)
+        return (sht3x.celsius_to_counts(self.__temperatures[self.__i]), 1)
+
+
+    def humidity(self) -> float:
+        return 45.0
+
+
+    def window(self) -> list:
+        return []
+
+
+    def restore(self, window: list, humidity: float, oldest: float) -> int:
+        return 0
+
+
+class FakeRelays():
+    def __init__(self):
+        self.__status = bytearray(b'\x00\x00\x00\x00')
+
+
+    def close(self, timeout: float = None):
+        pass
+
+
+    def get_status(self) -> bytearray:
+        return bytes(self.__status)
+
+
+    def reset_mcusr(self) -> int:
+        self.__status[relays.MCUSR] = 0
+        return 0
+
+
+    def relay_on(self, relay: int) -> int:
+        self.__status[relay] = relays.RELAY_STATUS_ON
+        return relays.RELAY_STATUS_ON
+
+
+    def relay_off(self, relay: int) -> int:
+        self.__status[relay] = relays.RELAY_STATUS_OFF
+        return relays.RELAY_STATUS_OFF
+
+
+    def relay_all_off(self, timeout: float = None) -> bytearray:
+        self.__status = bytearray(b'\x00\x00\x00\x00')
+        return bytes(self.__status)
+
+
+class FakeFan():
+    def on(self):
+        pass
+
+
+    def off(self, timeout: float = None):
+        pass
+
+
+    def set_pwm_duty(self, duty: int):
+        pass
+
+
+    def get_rpm(self) -> int:
+        return 1800
+
+
+def measure(function) -> dict:
+    """Time function() in rounds long enough to swamp timer resolution."""
+    number = 1
+    while True:
+        time_in = time.perf_counter()
+        for _ in range(number):
+            function()
+        if time.perf_counter() - time_in >= MIN_ROUND_TIME:
+            break
+        number *= 2
+
+    rounds = []
+    for _ in range(REPEAT):
+        time_in = time.perf_counter()
+        for _ in range(number):
+            function()
+        rounds.append((time.perf_counter() - time_in) / number)
+
+    return {
+        'number': number,
+        'min': min(rounds),
+        'median': statistics.median(rounds),
+        'mean': statistics.mean(rounds),
+        'stdev': statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+    }
+
+
+def bench_sht3x(results: dict):
+    data = bytes([0x66, 0x66, 0x00, 0x80, 0x00, 0x00])
+    for samples in SAMPLE_SIZES:
+        sht = sht3x.Sht3x('bench',sht3x.SHT3X_PERIODIC_1_HIGH,samples)
+        # Start from a full window, the steady state on a running unit.
+        for _ in range(samples):
+            sht.sample(data)
+        results[f'sht3x.sample[{samples}]'] = measure(lambda: sht.sample(data))
+
+
+def bench_control(results: dict, ctl: Control):
+    ctl.set_setpoints(control.Setpoints(control.MODE_AUTO,21.0,24.0,control.MODE_AUTO,Config.instance().temp_hysteresis()))
+    results['control.tick'] = measure(ctl.tick)
+
+    status = {control.TEMPERATURE: 22.5, control.HUMIDITY: 45.0, control.STATE: control.STATE_IDLE, control.OUTPUT: 'off', control.FAN: control.MODE_AUTO, control.FAN_STATE: 'off'}
+    results['control.publish'] = measure(lambda: ctl._Control__publish(status))
+
+
+def bench_settings(results: dict, settings: Settings, topic: str):
+    commands = {
+        Settings.CMD_GET_SETTINGS: {Settings.CMD: Settings.CMD_GET_SETTINGS},
+        Settings.CMD_PUT_SETTINGS: {Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: {'mode': control.MODE_AUTO, control.MODE_HEAT: 21.0, control.MODE_COOL: 24.0}},
+        Settings.CMD_GET_FAN: {Settings.CMD: Settings.CMD_GET_FAN},
+        Settings.CMD_PUT_FAN: {Settings.CMD: Settings.CMD_PUT_FAN, Settings.RESULT: {control.FAN: control.MODE_AUTO}},
+        Settings.CMD_GET_SCHEDULE: {Settings.CMD: Settings.CMD_GET_SCHEDULE},
+        'batch': [{Settings.CMD: Settings.CMD_GET_SETTINGS}, {Settings.CMD: Settings.CMD_GET_FAN}],
+        'invalid': {Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: {'mode': 'bogus'}},
+    }
+    # Commands run from the scheduler once admitted; both halves are measured on their own.
+    handle = settings._Settings__handle
+    for (name, command) in commands.items():
+        payload = json.dumps(command).encode()
+        results[f'settings.{name}'] = measure(lambda: handle(json.loads(payload),topic,None))
+
+    admit = settings._Settings__admit
+    results['settings.admit'] = measure(lambda: admit(topic,1))
+
+
+def bench_fan(results: dict):
+    fan = Fan('bench',None,None,None,False)
+    with tempfile.TemporaryFile() as f:
+        f.write(b'1\n')
+        f.flush()
+        fd = f.fileno()
+        results['fan.rpm_edge'] = measure(lambda: fan.rpm_edge(fd))
+    results['fan.rpm_update'] = measure(lambda: fan.rpm_update(1.0))
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    ok = True
+    for (name, result) in sorted(results.items()):
+        if not name in baseline:
+            print(f'{name:32} {result["median"] * 1e6:10.2f}us  (new)')
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = '  REGRESSION'
+            ok = False
+        print(f'{name:32} {result["median"] * 1e6:10.2f}us  {ratio:6.2f}x{flag}')
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m thermostat.bench')
+    parser.add_argument('--output',help='write results to this JSON file')
+    parser.add_argument('--compare',help='baseline JSON file from an earlier run')
+    parser.add_argument('--threshold',type=float,default=THRESHOLD,help='allowed median slowdown, as a fraction')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.CRITICAL + 1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        Config({'thermostat': {
+            'sht3x-device': 'bench',
+            'i2c-device': 'bench',
+            'relay-address': 0x10,
+            'fan-pwr-gpio': 'bench',
+            'settings-file': os.path.join(directory,'settings.json'),
+            'settings-debounce': 0,
+        }})
+        Mqtt({'mqtt': {'clientid': 'thermostat-bench'}})
+        Publisher()
+        Scheduler()
+
+        results = {}
+        try:
+            ctl = Control(sht=FakeSht3x([20.0, 22.5, 25.0, 22.5]),relay=FakeRelays(),board_fan=FakeFan())
+            settings = Settings()
+            ctl.open()
+
+            bench_sht3x(results)
+            bench_control(results,ctl)
+            bench_settings(results,settings,Config.instance().topic())
+            bench_fan(results)
+        finally:
+            Scheduler.instance().stop()
+            Publisher.instance().stop()
+
+    document = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.time(),
+        'results': results,
+    }
+
+    if not args.output is None:
+        with open(args.output,'w') as f:
+            json.dump(document,f,indent=2)
+
+    if not args.compare is None:
+        with open(args.compare,'r') as f:
+            baseline = json.load(f)['results']
+        return 0 if compare(results,baseline,args.threshold) else 1
+
+    for (name, result) in sorted(results.items()):
+        print(f'{name:32} {result["median"] * 1e6:10.2f}us')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,12 @@
+import os
+
 
 COMMON = 'common'
 TOPIC_ROOT = 'topic-root'
 LOGGER = 'logger'
 THERMOSTAT = 'thermostat'
 SHT3X_DEVICE = 'sht3x-device'
+SHT3X_MODE = 'sht3x-mode'
 I2C_DEVICE = 'i2c-device'
 I2C_RELAY_ADDR = 'relay-address'
 FAN_PWR_GPIO = 'fan-pwr-gpio'
@@ -15,10 +18,52 @@ SETTINGS_FILE = 'settings-file'
 TEMP_SAMPLES = 'temp-samples'
 TEMP_HYSTERESIS = 'temp-hysteresis'
 AUTO_TEMP_DELTA = 'auto-temp-delta'
+SETTINGS_DEBOUNCE = 'settings-debounce'
+ACTION_RATE = 'action-rate'
+ACTION_BURST = 'action-burst'
+ACTION_MAX_SIZE = 'action-max-size'
+SCHEDULE_FILE = 'schedule-file'
+SNAPSHOT_FILE = 'snapshot-file'
+SNAPSHOT_MAX_AGE = 'snapshot-max-age'
+BACKFILL_FILE = 'backfill-file'
+SHUTDOWN_TIMEOUT = 'shutdown-timeout'
+RUNTIME = 'runtime'
+METRICS_PORT = 'metrics-port'
+RAW_PERIOD = 'raw-period'
+QUERY_SOCKET = 'query-socket'
+RSS_TARGET = 'rss-target'
+ZONES = 'zones'
+ZONE_REQUIRED = (SHT3X_DEVICE, I2C_RELAY_ADDR, SETTINGS_FILE)
+RUNTIME_THREADS = 'threads'
+RUNTIME_ASYNCIO = 'asyncio'
+# Periodic measurement modes, named by measurements per second and repeatability,
+# in the order of the driver's SHT3X_PERIODIC_* arguments.
+SHT3X_MODES = ('periodic-0.5-low', 'periodic-0.5-med', 'periodic-0.5-high',
+               'periodic-1-low', 'periodic-1-med', 'periodic-1-high',
+               'periodic-2-low', 'periodic-2-med', 'periodic-2-high',
+               'periodic-4-low', 'periodic-4-med', 'periodic-4-high',
+               'periodic-10-low', 'periodic-10-med', 'periodic-10-high')
+SHT3X_MODE_DEFAULT = 'periodic-1-high'
+SCHEDULE_FILE_DEFAULT = 'schedule.json'
+SNAPSHOT_FILE_DEFAULT = 'snapshot.json'
+SNAPSHOT_MAX_AGE_DEFAULT = 300
+BACKFILL_FILE_DEFAULT = 'backfill.json'
 TEMP_SAMPLES_DEFAULT = 150
 TEMP_HYSTERESIS_DEFAULT = 0.2778
-AUTO_TEMP_DELTA = 0.5556
+AUTO_TEMP_DELTA_DEFAULT = 0.5556
 FAN_PWM_DUTY_DEFAULT = 50
+SETTINGS_DEBOUNCE_DEFAULT = 5.0
+ACTION_RATE_DEFAULT = 5.0
+ACTION_BURST_DEFAULT = 20
+ACTION_MAX_SIZE_DEFAULT = 65536
+SHUTDOWN_TIMEOUT_DEFAULT = 0.1
+# A raw batch counts its samples in 16 bits and times them in 32 bits of
+# microseconds. With room for a publish running twice as late, both fit at
+# the fastest 10Hz mode up to about 2147s (2**32us / 2) and 3276s (65535 / 20).
+RAW_PERIOD_MAX = 2000
+
+# Accessors whose values are only picked up when the daemon starts.
+RESTART_REQUIRED = ('topic', 'zone', 'sht3x_device', 'sht3x_mode', 'i2c_device', 'i2c_relay_addr', 'fan_pwr_gpio', 'fan_rpm_gpio', 'fan_pwm_module', 'fan_pwm_period', 'settings_file', 'schedule_file', 'snapshot_file', 'backfill_file', 'runtime', 'metrics_port', 'raw_period', 'query_socket', 'rss_target')
 
 
 class Config():
@@ -38,16 +83,128 @@ class Config():
             raise Exception('Singleton instance already created.')
 
         self.__parse_config(config)
+        self.__on_reload = []
+        self.__zones = self.__parse_zones(config)
 
         Config.__instance = self
 
 
+    def register_on_reload(self, callback):
+        self.__on_reload.append(callback)
+
+
+    def reload(self, config) -> list:
+        """Replace the configuration and notify the registered callbacks; returns what needs a restart."""
+        # Parsed in full first, so a bad file leaves the running values untouched.
+        fresh = object.__new__(Config)
+        fresh.__parse_config(config)
+        zones = fresh.__parse_zones(config)
+
+        restart = fresh.__restart_required(self)
+        fresh.__keep_running(self)
+        if zones.keys() != self.__zones.keys():
+            # Zones cannot be added or removed while running.
+            restart.append(ZONES)
+
+        # Zone objects are held by their Control and Settings, so they are
+        # updated in place rather than replaced.
+        for (name, zone) in self.__zones.items():
+            if name in zones:
+                restart.extend(f'{name}/{changed}' for changed in zones[name].__restart_required(zone))
+                zones[name].__keep_running(zone)
+                zones[name].__on_reload = zone.__on_reload
+                zones[name].__zones = zone.__zones
+                zone.__dict__ = zones[name].__dict__
+
+        fresh.__on_reload = self.__on_reload
+        fresh.__zones = self.__zones
+        self.__dict__ = fresh.__dict__
+
+        for callback in self.__on_reload:
+            callback()
+        for zone in self.__zones.values():
+            for callback in zone.__on_reload:
+                callback()
+
+        return restart
+
+
+    def __keep_running(self, previous):
+        # Paths and devices are read live, so a changed one must not apply before the restart.
+        for name in RESTART_REQUIRED:
+            attribute = f'_Config__{name}'
+            if attribute in previous.__dict__:
+                self.__dict__[attribute] = previous.__dict__[attribute]
+
+
+    def zones(self) -> list:
+        """Configuration of each zone, or just this one when no zones are configured."""
+        return list(self.__zones.values()) if len(self.__zones) != 0 else [self]
+
+
+    def __parse_zones(self, config) -> dict:
+        # Each zone is its thermostat section with the zone's own keys laid over it.
+        zones = {}
+        if config is not None and THERMOSTAT in config and ZONES in config[THERMOSTAT]:
+            for (name, overrides) in config[THERMOSTAT][ZONES].items():
+                for key in ZONE_REQUIRED:
+                    if not key in overrides:
+                        raise Exception(f'Zone {name} must have its own {key} configuration.')
+
+                merged = dict(config)
+                merged[THERMOSTAT] = dict(config[THERMOSTAT],**overrides)
+                del merged[THERMOSTAT][ZONES]
+
+                zone = object.__new__(Config)
+                zone.__parse_config(merged)
+                zone.__topic = f'{zone.__topic}/{name}'
+                zone.__zone = name
+                if not SCHEDULE_FILE in overrides:
+                    zone.__schedule_file = os.path.join(os.path.dirname(zone.__settings_file),f'{name}-{SCHEDULE_FILE_DEFAULT}')
+                if not SNAPSHOT_FILE in overrides:
+                    zone.__snapshot_file = os.path.join(os.path.dirname(zone.__settings_file),f'{name}-{SNAPSHOT_FILE_DEFAULT}')
+                if not BACKFILL_FILE in overrides:
+                    zone.__backfill_file = os.path.join(os.path.dirname(zone.__settings_file),f'{name}-{BACKFILL_FILE_DEFAULT}')
+                zone.__on_reload = []
+                zone.__zones = {}
+                zones[name] = zone
+        return zones
+
+
+    def __restart_required(self, previous) -> list:
+        restart = []
+        for name in RESTART_REQUIRED:
+            try:
+                if getattr(self,name)() != getattr(previous,name)():
+                    restart.append(name)
+            except AttributeError:
+                # Zone level values that are absent from a zoned top level.
+                pass
+        return restart
+
+
     def __parse_config(self, config):
         self.__topic = THERMOSTAT
+        self.__zone = None
         self.__logger_config = None
         self.__temp_samples = TEMP_SAMPLES_DEFAULT
         self.__temp_hysteresis = TEMP_HYSTERESIS_DEFAULT
-        self.__auto_temp_delta = AUTO_TEMP_DELTA
+        self.__auto_temp_delta = AUTO_TEMP_DELTA_DEFAULT
+        self.__settings_debounce = SETTINGS_DEBOUNCE_DEFAULT
+        self.__action_rate = ACTION_RATE_DEFAULT
+        self.__action_burst = ACTION_BURST_DEFAULT
+        self.__action_max_size = ACTION_MAX_SIZE_DEFAULT
+        self.__schedule_file = None
+        self.__snapshot_file = None
+        self.__snapshot_max_age = SNAPSHOT_MAX_AGE_DEFAULT
+        self.__backfill_file = None
+        self.__runtime = RUNTIME_THREADS
+        self.__shutdown_timeout = SHUTDOWN_TIMEOUT_DEFAULT
+        self.__metrics_port = None
+        self.__sht3x_mode = SHT3X_MODE_DEFAULT
+        self.__raw_period = None
+        self.__query_socket = None
+        self.__rss_target = None
 
         self.__fan_rpm_gpio = None
         self.__fan_pwm_module = None
@@ -66,6 +223,11 @@ class Config():
                 if SHT3X_DEVICE in config[THERMOSTAT]:
                     self.__sht3x_device = config[THERMOSTAT][SHT3X_DEVICE]
 
+                if SHT3X_MODE in config[THERMOSTAT]:
+                    if not config[THERMOSTAT][SHT3X_MODE] in SHT3X_MODES:
+                        raise Exception(f'SHT3X mode is unknown value \'{config[THERMOSTAT][SHT3X_MODE]}\'')
+                    self.__sht3x_mode = config[THERMOSTAT][SHT3X_MODE]
+
                 if I2C_DEVICE in config[THERMOSTAT]:
                     self.__i2c_device = config[THERMOSTAT][I2C_DEVICE]
 
@@ -90,6 +252,60 @@ class Config():
                 if SETTINGS_FILE in config[THERMOSTAT]:
                     self.__settings_file = config[THERMOSTAT][SETTINGS_FILE]
 
+                if SCHEDULE_FILE in config[THERMOSTAT]:
+                    self.__schedule_file = config[THERMOSTAT][SCHEDULE_FILE]
+
+                if SNAPSHOT_FILE in config[THERMOSTAT]:
+                    self.__snapshot_file = config[THERMOSTAT][SNAPSHOT_FILE]
+
+                if SNAPSHOT_MAX_AGE in config[THERMOSTAT]:
+                    if config[THERMOSTAT][SNAPSHOT_MAX_AGE] >= 0:
+                        self.__snapshot_max_age = config[THERMOSTAT][SNAPSHOT_MAX_AGE]
+
+                if BACKFILL_FILE in config[THERMOSTAT]:
+                    self.__backfill_file = config[THERMOSTAT][BACKFILL_FILE]
+
+                if RUNTIME in config[THERMOSTAT]:
+                    if config[THERMOSTAT][RUNTIME] != RUNTIME_THREADS and config[THERMOSTAT][RUNTIME] != RUNTIME_ASYNCIO:
+                        raise Exception(f'Runtime is unknown value \'{config[THERMOSTAT][RUNTIME]}\'')
+                    self.__runtime = config[THERMOSTAT][RUNTIME]
+
+                if METRICS_PORT in config[THERMOSTAT]:
+                    self.__metrics_port = config[THERMOSTAT][METRICS_PORT]
+
+                if RAW_PERIOD in config[THERMOSTAT]:
+                    if config[THERMOSTAT][RAW_PERIOD] > RAW_PERIOD_MAX:
+                        raise Exception(f'Raw period must be at most {RAW_PERIOD_MAX}s.')
+                    if config[THERMOSTAT][RAW_PERIOD] > 0:
+                        self.__raw_period = config[THERMOSTAT][RAW_PERIOD]
+
+                if QUERY_SOCKET in config[THERMOSTAT]:
+                    self.__query_socket = config[THERMOSTAT][QUERY_SOCKET]
+
+                if RSS_TARGET in config[THERMOSTAT]:
+                    if config[THERMOSTAT][RSS_TARGET] > 0:
+                        self.__rss_target = config[THERMOSTAT][RSS_TARGET]
+
+                if SHUTDOWN_TIMEOUT in config[THERMOSTAT]:
+                    if config[THERMOSTAT][SHUTDOWN_TIMEOUT] > 0:
+                        self.__shutdown_timeout = config[THERMOSTAT][SHUTDOWN_TIMEOUT]
+
+                if SETTINGS_DEBOUNCE in config[THERMOSTAT]:
+                    if config[THERMOSTAT][SETTINGS_DEBOUNCE] >= 0:
+                        self.__settings_debounce = config[THERMOSTAT][SETTINGS_DEBOUNCE]
+
+                if ACTION_RATE in config[THERMOSTAT]:
+                    if config[THERMOSTAT][ACTION_RATE] >= 0:
+                        self.__action_rate = config[THERMOSTAT][ACTION_RATE]
+
+                if ACTION_BURST in config[THERMOSTAT]:
+                    if config[THERMOSTAT][ACTION_BURST] >= 1:
+                        self.__action_burst = config[THERMOSTAT][ACTION_BURST]
+
+                if ACTION_MAX_SIZE in config[THERMOSTAT]:
+                    if config[THERMOSTAT][ACTION_MAX_SIZE] > 0:
+                        self.__action_max_size = config[THERMOSTAT][ACTION_MAX_SIZE]
+
                 if LOGGER in config[THERMOSTAT]:
                     self.__logger_config = config[THERMOSTAT][LOGGER]
 
@@ -101,33 +317,54 @@ class Config():
                         self.__temp_hysteresis = config[THERMOSTAT][TEMP_HYSTERESIS]
 
                 if AUTO_TEMP_DELTA in config[THERMOSTAT]:
-                    if config[THERMOSTAT][AUTO_TEMP_DELTA] > AUTO_TEMP_DELTA:
+                    if config[THERMOSTAT][AUTO_TEMP_DELTA] > AUTO_TEMP_DELTA_DEFAULT:
                         self.__auto_temp_delta = config[THERMOSTAT][AUTO_TEMP_DELTA]
 
-        if not hasattr(self,'_Config__sht3x_device'):
+        # With zones the per-zone devices and files are checked on each zone instead.
+        zoned = config is not None and THERMOSTAT in config and ZONES in config[THERMOSTAT]
+
+        if not zoned and not hasattr(self,'_Config__sht3x_device'):
             raise Exception('SHT3X device configuration must exist.')
 
         if not hasattr(self,'_Config__i2c_device'):
             raise Exception('I2C device configuration must exist.')
 
-        if not hasattr(self,'_Config__i2c_relay_addr'):
+        if not zoned and not hasattr(self,'_Config__i2c_relay_addr'):
             raise Exception('Relay address configuration must exist.')
 
         if not hasattr(self,'_Config__fan_pwr_gpio'):
             raise Exception('Fan gpio configuration must exist.')
 
-        if not hasattr(self,'_Config__settings_file'):
+        if not zoned and not hasattr(self,'_Config__settings_file'):
             raise Exception('Settings file configuration must exist.')
 
+        if self.__schedule_file is None and hasattr(self,'_Config__settings_file'):
+            # Keep the schedule next to the settings file unless told otherwise.
+            self.__schedule_file = os.path.join(os.path.dirname(self.__settings_file),SCHEDULE_FILE_DEFAULT)
+
+        if self.__snapshot_file is None and hasattr(self,'_Config__settings_file'):
+            self.__snapshot_file = os.path.join(os.path.dirname(self.__settings_file),SNAPSHOT_FILE_DEFAULT)
+
+        if self.__backfill_file is None and hasattr(self,'_Config__settings_file'):
+            self.__backfill_file = os.path.join(os.path.dirname(self.__settings_file),BACKFILL_FILE_DEFAULT)
+
 
     def topic(self) -> str:
         return self.__topic
 
 
+    def zone(self) -> str:
+        return self.__zone
+
+
     def sht3x_device(self) -> str:
         return self.__sht3x_device
 
 
+    def sht3x_mode(self) -> str:
+        return self.__sht3x_mode
+
+
     def i2c_device(self) -> str:
         return self.__i2c_device
 
@@ -160,6 +397,69 @@ class Config():
         return self.__settings_file
 
 
+    def schedule_file(self) -> str:
+        return self.__schedule_file
+
+
+    def snapshot_file(self) -> str:
+        return self.__snapshot_file
+
+
+    def snapshot_max_age(self) -> float:
+        return self.__snapshot_max_age
+
+
+    def backfill_file(self) -> str:
+        return self.__backfill_file
+
+
+    def runtime(self) -> str:
+        return self.__runtime
+
+
+    def metrics_port(self) -> int:
+        return self.__metrics_port
+
+
+    def raw_period(self) -> float:
+        return self.__raw_period
+
+
+    def query_socket(self) -> str:
+        return self.__query_socket
+
+
+    def rss_target(self) -> int:
+        """RSS target in bytes; configured in MiB. Setting one selects low-memory mode."""
+        return None if self.__rss_target is None else int(self.__rss_target * 1024 * 1024)
+
+
+    def low_memory(self) -> bool:
+        return not self.__rss_target is None
+
+
+    def shutdown_timeout(self) -> float:
+        return self.__shutdown_timeout
+
+
+    def settings_debounce(self) -> float:
+        return self.__settings_debounce
+
+
+    def action_rate(self) -> float:
+        """Action messages per second allowed from each client; 0 turns the limit off."""
+        return self.__action_rate
+
+
+    def action_burst(self) -> int:
+        return self.__action_burst
+
+
+    def action_max_size(self) -> int:
+        """Largest action payload in bytes that is parsed."""
+        return self.__action_max_size
+
+
     def logger_config(self) -> dict:
         return self.__logger_config
 
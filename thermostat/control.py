@@ -1,4 +1,7 @@
+import collections
 import json
+import logging
+import os
 import threading
 import time
 
@@ -6,7 +9,11 @@ import time
 from project_common.logger import logger
 from project_common.mqtt import Mqtt, mqtt
 
-from .config import Config
+from .config import Config, RUNTIME_THREADS, SHT3X_MODES
+from .publisher import Publisher, PRIORITY_HIGH, PRIORITY_STATUS, PRIORITY_LOW
+from .scheduler import Scheduler
+from . import metrics
+from . import startup
 from . import sht3x
 from . import relays
 from . import fan
@@ -28,239 +35,605 @@ OUTPUT = 'output'
 FAN_STATE = 'fan-state'
 OOS = 'out-of-service'
 
+CONTROL_KEY = 'control'
+CONTROL_PERIOD = 1.0
+# Part of a stop timeout kept back from waiting on a tick, for forcing the
+# relays off and releasing the devices within the timeout.
+STOP_RESERVE = 0.02
+
+RAW = 'raw'
+# Room in a raw batch for publishes that run late.
+RAW_HEADROOM = 2
+
+SNAPSHOT_KEY = 'snapshot'
+SNAPSHOT_PERIOD = 60.0
+# Snapshot document keys
+SNAPSHOT_TIME = 'time'
+SNAPSHOT_WINDOW = 'window'
+SNAPSHOT_STATUS = 'status'
+SNAPSHOT_RELAYS = 'relays'
+
+BACKFILL = 'backfill'
+# Status changes kept while the broker is away, and rows per backfill message.
+BACKFILL_SIZE = 1000
+BACKFILL_BATCH = 100
+# Backfill rows are [time, temperature, humidity, state, output, fan, fan-state];
+# an out-of-service row has the state out-of-service and no other values.
+BACKFILL_FIELDS = ('time', TEMPERATURE, HUMIDITY, STATE, OUTPUT, FAN, FAN_STATE)
+BACKFILL_FIELDS_KEY = 'fields'
+BACKFILL_ROWS_KEY = 'rows'
+
+STATES = frozenset([STATE_IDLE, MODE_HEAT, MODE_COOL])
+
+
+class Setpoints():
+    # Immutable and swapped as one reference, so a tick reads a consistent set
+    # without locking. Thresholds are in SHT3x counts so the tick compares integers.
+    __slots__ = ('mode', 'heat', 'cool', 'blower', 'heat_off', 'heat_on', 'cool_off', 'cool_on')
+
+
+    def __init__(self, mode: str, heat: float, cool: float, blower: str, hysteresis: float):
+        object.__setattr__(self,'mode',mode)
+        object.__setattr__(self,'heat',heat)
+        object.__setattr__(self,'cool',cool)
+        object.__setattr__(self,'blower',blower)
+        # Heating starts at or below heat_on and stops at or above heat_off;
+        # cooling starts at or above cool_on and stops at or below cool_off.
+        object.__setattr__(self,'heat_off',sht3x.celsius_to_counts(heat))
+        object.__setattr__(self,'heat_on',sht3x.celsius_to_counts(heat - hysteresis))
+        object.__setattr__(self,'cool_off',sht3x.celsius_to_counts(cool))
+        object.__setattr__(self,'cool_on',sht3x.celsius_to_counts(cool + hysteresis))
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
 
 class Control():
-    __instance = None
+    # One instance per zone, keyed by zone name (None without zones).
+    __instances = {}
+    # The board fan is shared by every zone.
+    __board_fan = None
+
+    __slots__ = ('__config', '__sht', '__relay', '__fan', '__topic', '__tick_key', '__snapshot_key', '__raw_key', '__raw_topic', '__backfill_topic',
+                 '__setpoints', '__lock', '__stopping', '__out_of_service', '__last_status', '__relay_seen',
+                 '__backfill_lock', '__backfill', '__backfill_dirty', '__connected', '__on_status', '__debug')
 
 
     @staticmethod
-    def instance():
-        if Control.__instance is None:
+    def instance(zone: str = None):
+        if not zone in Control.__instances:
             raise Exception('Instance has not been created.')
 
-        return Control.__instance
+        return Control.__instances[zone]
 
 
-    def __init__(self):
-        if Control.__instance is not None:
-            raise Exception('Singleton instance already created.')
+    @staticmethod
+    def instances() -> list:
+        return list(Control.__instances.values())
 
-        logger.info(f'Using {Config.instance().temp_samples()} temperature samples.')
-        logger.info(f'Using {Config.instance().temp_hysteresis():.3f}C temperature hysteresis.')
 
-        self.__sht = sht3x.Sht3x(Config.instance().sht3x_device(),sht3x.SHT3X_PERIODIC_1_HIGH,Config.instance().temp_samples())
-        self.__relay = relays.Relays(Config.instance().i2c_device(),Config.instance().i2c_relay_addr())
-        self.__fan = fan.Fan(Config.instance().fan_pwr_gpio(),Config.instance().fan_rpm_gpio(),Config.instance().fan_pwm_module(),Config.instance().fan_pwm_period())
+    def __init__(self, config: Config = None, sht: sht3x.Sht3x = None, relay: relays.Relays = None, board_fan: fan.Fan = None):
+        # sht, relay and board_fan stand in for the hardware devices when given.
+        self.__config = Config.instance() if config is None else config
 
-        self.__topic = Config.instance().topic()
+        if self.__config.zone() in Control.__instances:
+            raise Exception('Singleton instance already created.')
 
+        logger.info(f'Using {self.__config.temp_samples()} temperature samples.')
+        logger.info(f'Using {self.__config.temp_hysteresis():.3f}C temperature hysteresis.')
+
+        # Devices not given here are brought up by open().
+        if Control.__board_fan is None:
+            Control.__board_fan = board_fan
+        self.__sht = sht
+        self.__relay = relay
+        self.__fan = Control.__board_fan
+
+        self.__topic = self.__config.topic()
+        suffix = '' if self.__config.zone() is None else f'/{self.__config.zone()}'
+        self.__tick_key = f'{CONTROL_KEY}{suffix}'
+        self.__snapshot_key = f'{SNAPSHOT_KEY}{suffix}'
+        self.__raw_key = f'{RAW}{suffix}'
+        self.__raw_topic = f'{self.__topic}/{RAW}'
+        self.__backfill_topic = f'{self.__topic}/{BACKFILL}'
+
+        self.__config.register_on_reload(self.__on_reload)
         Mqtt.instance().register_on_connect(self.__on_connect)
         Mqtt.instance().register_on_disconnect(self.__on_disconnect)
-        Mqtt.instance().will_set(self.__topic,payload=OOS,qos=2)
+        # There is one will per connection, so zones share the top level topic for it.
+        Mqtt.instance().will_set(Config.instance().topic(),payload=OOS,qos=2)
+
+        # Replaced as a whole by Settings; None until the first push.
+        self.__setpoints = None
+
+        # Held for a tick so stop() can wait for it before turning the relays off.
+        self.__lock = threading.Lock()
+        self.__stopping = False
+
+        # Checked once a tick so the debug lines cost nothing when they are off.
+        self.__debug = logger.isEnabledFor(logging.DEBUG)
+
+        self.__out_of_service = True
+        # Replaced, never modified, so it can be handed out to other threads.
+        self.__last_status = {TEMPERATURE: 0.0, HUMIDITY: 0.0, STATE: STATE_IDLE, OUTPUT: relays.RELAY_STATUS_STR[relays.RELAY_STATUS_OFF], FAN: MODE_OFF, FAN_STATE: relays.RELAY_STATUS_STR[relays.RELAY_STATUS_OFF]}
+        # relay -> (status, wall time it was first seen in that status)
+        self.__relay_seen = {relay: (None, None) for relay in relays.RELAY_NAME_STR}
+
+        # Status changes while disconnected, replayed on connect. Guarded by its
+        # own lock as the connect callbacks run on the MQTT thread.
+        self.__backfill_lock = threading.Lock()
+        self.__backfill = collections.deque(maxlen=BACKFILL_SIZE)
+        self.__backfill_dirty = False
+        self.__connected = False
+        self.__on_status = []
+        self.__load_backfill()
+
+        Control.__instances[self.__config.zone()] = self
+
+
+    def open(self):
+        """Bring up the devices that were not given to the constructor."""
+        # Not in the constructor, so the broker connection can come up while the hardware does.
+        # The asyncio runtime reads the sensor and counts tach edges on its loop.
+        threaded = Config.instance().runtime() == RUNTIME_THREADS
+        suffix = '' if self.__config.zone() is None else f'/{self.__config.zone()}'
+
+        if Control.__board_fan is None:
+            with startup.step('fan'):
+                Control.__board_fan = fan.Fan(Config.instance().fan_pwr_gpio(),Config.instance().fan_rpm_gpio(),Config.instance().fan_pwm_module(),Config.instance().fan_pwm_period(),threaded)
+        self.__fan = Control.__board_fan
+
+        if self.__sht is None:
+            with startup.step(f'sht3x{suffix}'):
+                mode = sht3x.SHT3X_PERIODIC_0P5_LOW + SHT3X_MODES.index(self.__config.sht3x_mode())
+                self.__sht = sht3x.Sht3x(self.__config.sht3x_device(),mode,self.__config.temp_samples())
+        if self.__relay is None:
+            with startup.step(f'relays{suffix}'):
+                self.__relay = relays.Relays(self.__config.i2c_device(),self.__config.i2c_relay_addr())
+
+        if not self.__config.raw_period() is None:
+            self.__sht.enable_raw(int(self.__config.raw_period() * self.__sht.rate() * RAW_HEADROOM) + 1)
+
+        # Picks up the filter window and control state from before a restart,
+        # so it has to happen before the sensor starts adding samples.
+        with startup.step(f'snapshot{suffix}'):
+            self.__restore_snapshot()
+        if threaded:
+            self.__sht.start()
+
+
+    def start(self):
+        self.__fan.on()
+        self.__fan.set_pwm_duty(self.__config.fan_pwm_duty())
+
+        # Every zone ticks from the one scheduler.
+        Scheduler.instance().every(self.__tick_key,CONTROL_PERIOD,self.tick,blocking=True)
+        Scheduler.instance().every(self.__snapshot_key,SNAPSHOT_PERIOD,self.__save_snapshot,blocking=True)
+        if not self.__config.raw_period() is None:
+            Scheduler.instance().every(self.__raw_key,self.__config.raw_period(),self.__publish_raw,blocking=True)
+
+
+    def stop(self, timeout: float = None):
+        """Turn every relay off and release the devices, forcing them off if a tick overruns timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        self.__stopping = True
+        Scheduler.instance().cancel(self.__tick_key)
+        Scheduler.instance().cancel(self.__snapshot_key)
+        if Scheduler.instance().cancel(self.__raw_key):
+            self.__publish_raw()
+
+        locked = self.__lock.acquire(timeout=-1 if timeout is None else max(timeout - STOP_RESERVE,0.0))
+        if not locked:
+            logger.warning('Control tick did not finish in time, forcing relays off.')
+        # A tick that overran is most likely stuck in an I2C transfer holding
+        # the bus, so the relays are forced off without waiting for it.
+        bus_timeout = self.__remaining(deadline) if locked else 0.0
+        try:
+            self.__relay.relay_all_off(bus_timeout)
+        except Exception as ex:
+            metrics.inc(metrics.RELAY_ERRORS)
+            logger.critical(ex)
+        finally:
+            self.__relay.close(bus_timeout)
+            if locked:
+                self.__lock.release()
+
+        # Let the broker know the thermostat is stopping.
+        self.__send(OOS,PRIORITY_HIGH)
+
+        if locked:
+            self.__save_snapshot()
+        else:
+            self.__save_backfill()
+
+        self.__sht.stop(self.__remaining(deadline))
+        self.__fan.off(self.__remaining(deadline))
+
+
+    def __remaining(self, deadline: float) -> float:
+        return None if deadline is None else max(deadline - time.monotonic(),0.0)
+
 
-        self.__mode = None
-        self.__heat = None
-        self.__cool = None
-        self.__blower = MODE_AUTO
+    def zone(self) -> str:
+        return self.__config.zone()
 
-        self.__stop_event = threading.Event()
-        self.__thread = threading.Thread(target=self.__thread_run,name='control')
-        self.__thread.start()
 
-        Control.__instance = self
+    def sht(self) -> sht3x.Sht3x:
+        return self.__sht
 
 
-    def stop(self):
-        self.__stop_event.set()
-        self.__thread.join()
-        self.__relay.relay_all_off()
-        self.__relay.close()
-        self.__sht.stop()
-        self.__fan.off()
+    def fan(self) -> fan.Fan:
+        return self.__fan
 
 
-    def set_mode(self, mode: str):
-        self.__mode = mode
+    def set_setpoints(self, setpoints: Setpoints):
+        self.__setpoints = setpoints
 
 
-    def set_blower(self, blower: str):
-        self.__blower = blower
+    def status(self) -> dict:
+        """The last status, or None while out of service."""
+        return None if self.__out_of_service else self.__last_status
 
 
-    def set_heat(self, heat: float):
-        self.__heat = heat
+    def connected(self) -> bool:
+        return self.__connected
 
 
-    def set_cool(self, cool: float):
-        self.__cool = cool
+    def register_on_status(self, callback):
+        """callback(zone, status) is called on the control thread for every status change; status is None when out of service."""
+        self.__on_status.append(callback)
+
+
+    def __on_reload(self):
+        # Hysteresis arrives with the next setpoints; the filter window and fan duty are applied here.
+        logger.info(f'Using {self.__config.temp_samples()} temperature samples.')
+        logger.info(f'Using {self.__config.temp_hysteresis():.3f}C temperature hysteresis.')
+        self.__sht.set_samples(self.__config.temp_samples())
+        self.__fan.set_pwm_duty(self.__config.fan_pwm_duty())
+        self.__debug = logger.isEnabledFor(logging.DEBUG)
 
 
     def __on_connect(self,client, userdata, flags, rc):
         if rc == mqtt.client.CONNACK_ACCEPTED:
             logger.info(f'Broker connected.')
 
+            with self.__backfill_lock:
+                self.__connected = True
+                rows = list(self.__backfill)
+                self.__backfill.clear()
+                self.__backfill_dirty = True
+
+            if len(rows) != 0:
+                # Subscribers get the current state live straight away; the
+                # history follows behind it at low priority.
+                if self.__out_of_service:
+                    self.__send(OOS,PRIORITY_HIGH)
+                else:
+                    self.__publish(self.__last_status)
+
+                logger.info(f'Backfilling {len(rows)} status changes.')
+                for i in range(0,len(rows),BACKFILL_BATCH):
+                    batch = {BACKFILL_FIELDS_KEY: BACKFILL_FIELDS, BACKFILL_ROWS_KEY: rows[i:i + BACKFILL_BATCH]}
+                    Publisher.instance().publish(self.__backfill_topic,json.dumps(batch),priority=PRIORITY_LOW)
+
 
     def __on_disconnect(self,client, userdata, rc):
+        with self.__backfill_lock:
+            self.__connected = False
+
         if rc != mqtt.client.MQTT_ERR_SUCCESS:
             # Broker was not asked to disconnect.
             logger.warning(f'Broker disconnected with rc={rc}')
 
 
-    def __thread_run(self):
-        self.__fan.on()
-        self.__fan.set_pwm_duty(Config.instance().fan_pwm_duty())
+    def tick(self):
+        """Run one control decision. Called once a second by the scheduler."""
+        time_in = time.monotonic()
+
+        with self.__lock:
+            if self.__stopping:
+                return
+            self.__tick()
 
-        out_of_service = True
+        duration = time.monotonic() - time_in
+        metrics.inc(metrics.CONTROL_TICKS)
+        metrics.inc(metrics.CONTROL_TICK_SECONDS,duration)
+        metrics.gauge(metrics.CONTROL_TICK_LAST_SECONDS,duration)
 
-        last_status = {TEMPERATURE: 0.0, HUMIDITY: 0.0, STATE: STATE_IDLE, OUTPUT: relays.RELAY_STATUS_STR[relays.RELAY_STATUS_OFF], FAN: MODE_OFF, FAN_STATE: relays.RELAY_STATUS_STR[relays.RELAY_STATUS_OFF]}
+        time_over = round(duration - CONTROL_PERIOD,3)
+        if time_over > 0:
+            metrics.inc(metrics.CONTROL_TICK_OVERRUNS)
+            logger.debug(f'Went over on time {time_over:1.3f}')
 
-        while not self.__stop_event.is_set():
-            time_in = time.monotonic()
 
-            fan_rpm = self.__fan.get_rpm()
-            if not fan_rpm is None:
+    def __tick(self):
+        fan_rpm = self.__fan.get_rpm()
+        if not fan_rpm is None:
+            metrics.gauge(metrics.FAN_RPM,fan_rpm)
+            if self.__debug:
                 logger.debug(f'Fan RPM = {fan_rpm}')
 
+        try:
+            relay_status = self.__relay.get_status()
+        except Exception as ex:
+            metrics.inc(metrics.RELAY_ERRORS)
+            logger.critical(ex)
+            return
+
+        if self.__debug:
+            self.__log_relay_status(relay_status)
+        self.__observe_relays(relay_status)
+
+        if relay_status[relays.MCUSR] != 0:
+            metrics.inc(metrics.RELAY_RESETS)
+            logger.warning(f'Relay controller has reset with code {relay_status[relays.MCUSR]}')
             try:
-                relay_status = self.__relay.get_status()
+                mcusr = self.__relay.reset_mcusr()
             except Exception as ex:
+                metrics.inc(metrics.RELAY_ERRORS)
                 logger.critical(ex)
-                time.sleep(1)
-                continue
+            else:
+                if  mcusr != 0:
+                    logger.error(f'Relay controller status did not reset code={mcusr}')
+
+        # Read once so the whole tick works from the same settings.
+        setpoints = self.__setpoints
+
+        counts = self.__sht.counts()
+        if not counts is None and not setpoints is None:
+            mode = setpoints.mode
+            blower = setpoints.blower
+            # Decisions compare the window's sum against threshold * samples,
+            # so they are exact; temp is only for publishing and logging.
+            (tempsum, samples) = counts
+            temp = round(sht3x.counts_to_celsius(tempsum / samples) + 0.0001,3)
+            humid = round(self.__sht.humidity() + 0.01,1)
+            if self.__debug:
+                self.__log_sht(temp,humid)
 
-            self.__log_relay_status(relay_status)
+            state = self.__last_status[STATE]
 
-            if relay_status[relays.MCUSR] != 0:
-                logger.warning(f'Relay controller has reset with code {relay_status[relays.MCUSR]}')
-                try:
-                    mcusr = self.__relay.reset_mcusr()
-                except Exception as ex:
-                    logger.critical(ex)
-                else:
-                    if  mcusr != 0:
-                        logger.error(f'Relay controller status did not reset code={mcusr}')
+            fan_state = relays.RELAY_STATUS_STR[relay_status[relays.RELAY_FAN]]
 
-            temp = self.__sht.temperature(sht3x.UNITS_CELCIUS)
-            if not temp is None and not self.__mode is None and not self.__blower is None and not self.__heat is None and not self.__cool is None:
-                temp = round(temp + 0.0001,3)
-                humid = round(self.__sht.humidity() + 0.01,1)
-                self.__log_sht(temp,humid)
+            if relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_ON or relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_ON:
+                output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_ON]
+            elif relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_LOCKED or relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_LOCKED:
+                output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]
+            else:
+                output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_OFF]
 
-                state = last_status[STATE]
+            if mode == MODE_OFF:
+                state = STATE_IDLE
 
-                fan_state = relays.RELAY_STATUS_STR[relay_status[relays.RELAY_FAN]]
+            if mode == MODE_COOL or mode == MODE_AUTO:
+                if (mode == MODE_COOL or state == MODE_COOL) and tempsum <= setpoints.cool_off * samples:
+                    state = STATE_IDLE
+                if tempsum >= setpoints.cool_on * samples:
+                    state = MODE_COOL
 
-                if relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_ON or relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_ON:
-                    output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_ON]
-                elif relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_LOCKED or relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_LOCKED:
+            if mode == MODE_HEAT or mode == MODE_AUTO:
+                if (mode == MODE_HEAT or state == MODE_HEAT) and tempsum >= setpoints.heat_off * samples:
+                    state = STATE_IDLE
+                if tempsum <= setpoints.heat_on * samples:
+                    state = MODE_HEAT
+
+            if state == MODE_COOL:
+                if relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_ON:
+                    state = STATE_IDLE
+                    logger.warning('Cooling wanted while heat is on.')
+                elif relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_LOCKED or relay_status[relays.RELAY_FAN] == relays.RELAY_STATUS_LOCKED:
+                    # If heat/fan was on previously, wait for its lockout to clear before allowing cooling to be engaged.
                     output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]
+                    if output != self.__last_status[OUTPUT]:
+                        logger.info(f'Cooling currently locked out.')
                 else:
-                    output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_OFF]
-
-                if self.__mode == MODE_OFF:
+                    output = self.__relay_on(relays.RELAY_COOL)
+                    if state != self.__last_status[STATE]:
+                        logger.info(f'Cooling engaged at {temp:2.3f}C with relay status of {output}.')
+                    elif output != self.__last_status[OUTPUT]:
+                        logger.info(f'Cooling relay changed state to {output}.')
+
+            if state == MODE_HEAT:
+                if relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_ON:
                     state = STATE_IDLE
+                    logger.warning('Heating wanted while cooling is on.')
+                elif relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_LOCKED or relay_status[relays.RELAY_FAN] == relays.RELAY_STATUS_LOCKED:
+                    # If cooling/fan was on previously, wait for its lockout to clear before allowing heat to be engaged.
+                    output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]
+                    if output != self.__last_status[OUTPUT]:
+                        logger.info(f'Heating currently locked out.')
+                else:
+                    output = self.__relay_on(relays.RELAY_HEAT)
+                    if state != self.__last_status[STATE]:
+                        logger.info(f'Heating engaged at {temp:2.3f}C with relay status of {output}.')
+                    elif output != self.__last_status[OUTPUT]:
+                        logger.info(f'Heating relay changed state to {output}.')
+
+            if state == STATE_IDLE:
+                if relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_ON:
+                    output = self.__relay_off(relays.RELAY_COOL)
+                    if output != self.__last_status[OUTPUT]:
+                        logger.info('Cooling turned off.')
+                if relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_ON:
+                    output = self.__relay_off(relays.RELAY_HEAT)
+                    if output != self.__last_status[OUTPUT]:
+                        logger.info('Heating turned off.')
+
+            if (state == STATE_IDLE or output == relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]) and blower == MODE_AUTO and relay_status[relays.RELAY_FAN] == relays.RELAY_STATUS_ON:
+                fan_state = self.__relay_off(relays.RELAY_FAN)
+                logger.info('Fan turned off.')
+            if (state != STATE_IDLE and output != relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]) or blower == MODE_ON:
+                fan_state = self.__relay_on(relays.RELAY_FAN)
+                if self.__last_status[FAN_STATE] != relays.RELAY_STATUS_STR[relays.RELAY_STATUS_ON]:
+                    logger.info(f'Fan turned on with relay status of {fan_state}.')
+
+            # Compared field by field so a tick without a change allocates no status.
+            # Always publish after being out of service, even when nothing changed.
+            last = self.__last_status
+            if self.__out_of_service or temp != last[TEMPERATURE] or humid != last[HUMIDITY] or state != last[STATE] or output != last[OUTPUT] or blower != last[FAN] or fan_state != last[FAN_STATE]:
+                status = {TEMPERATURE: temp, HUMIDITY: humid, STATE: state, OUTPUT: output, FAN: blower, FAN_STATE: fan_state}
+                self.__report(status)
+                self.__last_status = status
+                self.__out_of_service = False
+
+        else:
+            if not self.__out_of_service:
+                self.__out_of_service = True
+                # Let the broker know something is wrong.
+                self.__report(None)
+
+
+    def __report(self,status: dict):
+        # Publish, or keep for backfill while the broker is away. None is out of service.
+        for callback in self.__on_status:
+            callback(self.__config.zone(),status)
+
+        with self.__backfill_lock:
+            if not self.__connected:
+                if len(self.__backfill) == self.__backfill.maxlen:
+                    metrics.inc(metrics.BACKFILL_DROPPED)
+                if status is None:
+                    self.__backfill.append([round(time.time(),3), None, None, OOS, None, None, None])
+                else:
+                    self.__backfill.append([round(time.time(),3)] + [status[field] for field in BACKFILL_FIELDS[1:]])
+                self.__backfill_dirty = True
+                return
 
-                if self.__mode == MODE_COOL or self.__mode == MODE_AUTO:
-                    if (self.__mode == MODE_COOL or state == MODE_COOL) and temp <= self.__cool:
-                        state = STATE_IDLE
-                    if temp >= (self.__cool + Config.instance().temp_hysteresis()):
-                        state = MODE_COOL
-
-                if self.__mode == MODE_HEAT or self.__mode == MODE_AUTO:
-                    if (self.__mode == MODE_HEAT or state == MODE_HEAT) and temp >= self.__heat:
-                        state = STATE_IDLE
-                    if temp <= (self.__heat - Config.instance().temp_hysteresis()):
-                        state = MODE_HEAT
-
-                if state == MODE_COOL:
-                    if relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_ON:
-                        state = STATE_IDLE
-                        logger.warning('Cooling wanted while heat is on.')
-                    elif relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_LOCKED or relay_status[relays.RELAY_FAN] == relays.RELAY_STATUS_LOCKED:
-                        # If heat/fan was on previously, wait for its lockout to clear before allowing cooling to be engaged.
-                        output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]
-                        if output != last_status[OUTPUT]:
-                            logger.info(f'Cooling currently locked out.')
-                    else:
-                        output = self.__relay_on(relays.RELAY_COOL)
-                        if state != last_status[STATE]:
-                            logger.info(f'Cooling engaged at {temp:2.3f}C with relay status of {output}.')
-                        elif output != last_status[OUTPUT]:
-                            logger.info(f'Cooling relay changed state to {output}.')
-
-                if state == MODE_HEAT:
-                    if relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_ON:
-                        state = STATE_IDLE
-                        logger.warning('Heating wanted while cooling is on.')
-                    elif relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_LOCKED or relay_status[relays.RELAY_FAN] == relays.RELAY_STATUS_LOCKED:
-                        # If cooling/fan was on previously, wait for its lockout to clear before allowing heat to be engaged.
-                        output = relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]
-                        if output != last_status[OUTPUT]:
-                            logger.info(f'Heating currently locked out.')
-                    else:
-                        output = self.__relay_on(relays.RELAY_HEAT)
-                        if state != last_status[STATE]:
-                            logger.info(f'Heating engaged at {temp:2.3f}C with relay status of {output}.')
-                        elif output != last_status[OUTPUT]:
-                            logger.info(f'Heating relay changed state to {output}.')
-
-                if state == STATE_IDLE:
-                    if relay_status[relays.RELAY_COOL] == relays.RELAY_STATUS_ON:
-                        output = self.__relay_off(relays.RELAY_COOL)
-                        if output != last_status[OUTPUT]:
-                            logger.info('Cooling turned off.')
-                    if relay_status[relays.RELAY_HEAT] == relays.RELAY_STATUS_ON:
-                        output = self.__relay_off(relays.RELAY_HEAT)
-                        if output != last_status[OUTPUT]:
-                            logger.info('Heating turned off.')
-
-                if (state == STATE_IDLE or output == relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]) and self.__blower == MODE_AUTO and relay_status[relays.RELAY_FAN] == relays.RELAY_STATUS_ON:
-                    fan_state = self.__relay_off(relays.RELAY_FAN)
-                    logger.info('Fan turned off.')
-                if (state != STATE_IDLE and output != relays.RELAY_STATUS_STR[relays.RELAY_STATUS_LOCKED]) or self.__blower == MODE_ON:
-                    fan_state = self.__relay_on(relays.RELAY_FAN)
-                    if last_status[FAN_STATE] != relays.RELAY_STATUS_STR[relays.RELAY_STATUS_ON]:
-                        logger.info(f'Fan turned on with relay status of {fan_state}.')
-
-                status = {TEMPERATURE: temp if not temp is None else 0.0, HUMIDITY: humid if not humid is None else 0.0, STATE: state, OUTPUT: output, FAN: self.__blower, FAN_STATE: fan_state}
-
-                if status != last_status:
-                    self.__publish(status)
-                    last_status = dict(status)
-                    out_of_service = False
-
-            else:
-                if not out_of_service:
-                    out_of_service = True
-                    # Let the broker know something is wrong.
-                    Mqtt.instance().publish(self.__topic,payload=OOS,qos=2)
-
-            # Try and get close to once-per-second periodicity.
-            time_left =  round(1.0 - (time.monotonic() - time_in),3)
-            if time_left > 0:
-                logger.debug(f'Sleeping for {time_left:1.3f}')
-                time.sleep(time_left)
-            else:
-                logger.debug(f'Went over on time {time_left:1.3f}')
-                time.sleep(0)
-
-        # Let the broker know the thermostat is stopping.
-        Mqtt.instance().publish(self.__topic,payload=OOS,qos=2)
+        if status is None:
+            self.__send(OOS,PRIORITY_HIGH)
+        else:
+            self.__publish(status)
 
 
     def __publish(self,dictionary: dict):
         try:
             p=json.dumps(dictionary)
-            Mqtt.instance().publish(self.__topic,payload=p,qos=2)
+            self.__send(p,PRIORITY_STATUS)
             logger.debug(p)
         except Exception as ex:
             logger.warning(ex)
 
 
+    def __publish_raw(self):
+        batch = self.__sht.take_raw()
+        if not batch is None:
+            # Sequence numbers in the batch expose losses, so QoS 0 is enough.
+            Publisher.instance().publish(self.__raw_topic,batch,qos=0,priority=PRIORITY_LOW)
+            metrics.inc(metrics.RAW_BATCHES)
+
+
+    def __send(self,payload: str,priority: int):
+        # Status and out-of-service share a key so only the latest of them is ever waiting.
+        Publisher.instance().publish(self.__topic,payload,priority=priority,key=self.__topic)
+
+
+    def __observe_relays(self,status: bytearray):
+        now = None
+        for (relay, (seen, since)) in self.__relay_seen.items():
+            if status[relay] != seen:
+                now = time.time() if now is None else now
+                if seen == relays.RELAY_STATUS_LOCKED and not since is None:
+                    logger.debug(f'Relay {relays.RELAY_NAME_STR[relay]} was locked out for {now - since:.0f}s')
+                self.__relay_seen[relay] = (status[relay], now)
+
+
+    def __load_backfill(self):
+        try:
+            with open(self.__config.backfill_file(),'r') as f:
+                rows = json.load(f)
+            for row in rows:
+                if not isinstance(row,list) or len(row) != len(BACKFILL_FIELDS):
+                    raise ValueError(f'Backfill row is malformed \'{row}\'')
+            self.__backfill.extend(rows)
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            logger.warning(f'Could not read/interpret file: \'{self.__config.backfill_file()}\'')
+            logger.debug(ex)
+
+
+    def __save_backfill(self):
+        with self.__backfill_lock:
+            if not self.__backfill_dirty:
+                return
+            rows = list(self.__backfill)
+            self.__backfill_dirty = False
+
+        try:
+            if len(rows) == 0:
+                if os.path.exists(self.__config.backfill_file()):
+                    os.remove(self.__config.backfill_file())
+            else:
+                with open(self.__config.backfill_file(),'w') as f:
+                    json.dump(rows,f)
+        except Exception as ex:
+            logger.warning(f'Could not write file: \'{self.__config.backfill_file()}\'')
+            logger.debug(ex)
+
+
+    def __save_snapshot(self):
+        snapshot = {
+            SNAPSHOT_TIME: time.time(),
+            SNAPSHOT_WINDOW: self.__sht.window(),
+            HUMIDITY: self.__sht.humidity(),
+            SNAPSHOT_STATUS: self.__last_status,
+            SNAPSHOT_RELAYS: {relays.RELAY_NAME_STR[relay]: seen for (relay, seen) in self.__relay_seen.items()},
+        }
+        try:
+            with open(self.__config.snapshot_file(),'w') as f:
+                json.dump(snapshot,f)
+        except Exception as ex:
+            logger.warning(f'Could not write file: \'{self.__config.snapshot_file()}\'')
+            logger.debug(ex)
+
+        # The outage buffer is persisted on the same cadence.
+        self.__save_backfill()
+
+
+    def __restore_snapshot(self):
+        try:
+            with open(self.__config.snapshot_file(),'r') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as ex:
+            logger.warning(f'Could not read/interpret file: \'{self.__config.snapshot_file()}\'')
+            logger.debug(ex)
+            return
+
+        try:
+            now = time.time()
+            age = now - snapshot[SNAPSHOT_TIME]
+            if age < 0 or age > self.__config.snapshot_max_age():
+                logger.info(f'Ignoring snapshot from {age:.0f}s ago.')
+                return
+
+            status = {key: snapshot[SNAPSHOT_STATUS][key] for key in self.__last_status}
+            if not status[STATE] in STATES:
+                raise ValueError(f'State is unknown value \'{status[STATE]}\'')
+            seen = {relay: tuple(snapshot[SNAPSHOT_RELAYS][name]) for (relay, name) in relays.RELAY_NAME_STR.items()}
+            window = [(float(t), int(counts)) for (t, counts) in snapshot[SNAPSHOT_WINDOW]]
+
+            samples = self.__sht.restore(window,float(snapshot[HUMIDITY]),now - self.__config.snapshot_max_age())
+            self.__last_status = status
+            self.__relay_seen = seen
+            logger.info(f'Restored {samples} samples and {status[STATE]} state from {age:.0f}s ago.')
+        except Exception as ex:
+            logger.warning(f'Could not read/interpret file: \'{self.__config.snapshot_file()}\'')
+            logger.debug(ex)
+
+
     def __relay_on(self,relay: int) -> str:
         try:
             _relay_status = self.__relay.relay_on(relay)
         except Exception as ex:
+            metrics.inc(metrics.RELAY_ERRORS)
             logger.critical(ex)
             _relay_status = relays.RELAY_STATUS_LOCKED
         # else:
@@ -273,6 +646,7 @@ class Control():
         try:
             _relay_status = self.__relay.relay_off(relay)
         except Exception as ex:
+            metrics.inc(metrics.RELAY_ERRORS)
             logger.critical(ex)
             _relay_status = relays.RELAY_STATUS_ON
         # else:
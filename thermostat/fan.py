@@ -7,10 +7,18 @@ from project_common.logger import logger
 
 PWM_PERIOD_DEFAULT = 1000000
 PWM_DUTY_DEFAULT = 0
+# The tach line pulses twice per revolution.
+PULSES_PER_REV = 2
 
 
 class Fan():
-    def __init__(self,pwr: str, rpm: str, pwm: str, pwm_period: int):
+    __slots__ = ('__pwr', '__rpm', '__pwm', '__pwm_period', '__duty', '__on', '__pulses',
+                 '__rpm_value', '__rpm_thread', '__rpm_thread_event')
+
+
+    def __init__(self,pwr: str, rpm: str, pwm: str, pwm_period: int, poll: bool = True):
+        """poll selects the rpm polling thread; without it the caller counts
+        tach edges through rpm_open()/rpm_edge()/rpm_update()."""
 
         self.__pwr = f'/sys/class/gpio/gpio{pwr}'
         self.__rpm = None
@@ -21,6 +29,8 @@ class Fan():
             self.__pwm_period = pwm_period
 
         self.__rpm_value = None
+        self.__rpm_thread = None
+        self.__pulses = 0
 
         self.__on = False
 
@@ -55,8 +65,9 @@ class Fan():
                 with open(f'{self.__rpm}/direction','w') as direction:
                     direction.write('in')
 
-                self.__rpm_thread_event = threading.Event()
-                self.__rpm_thread = threading.Thread(target=self.__rpm_thread_run,name='rpm')
+                if poll:
+                    self.__rpm_thread_event = threading.Event()
+                    self.__rpm_thread = threading.Thread(target=self.__rpm_thread_run,name='rpm')
 
             except Exception as e:
                 self.__rpm = None
@@ -103,13 +114,13 @@ class Fan():
                 logger.critical(e)
                 return
 
-            if not self.__rpm is None:
+            if not self.__rpm_thread is None:
                 self.__rpm_thread.start()
 
             self.set_pwm_enable(True)
 
 
-    def off(self):
+    def off(self, timeout: float = None):
         if self.__pwr is None:
             return
 
@@ -121,9 +132,11 @@ class Fan():
             except Exception as e:
                 logger.critical(f'Exception encoutered attempting to turn off {self.__pwr}: {e}')
 
-            if not self.__rpm is None:
+            if not self.__rpm_thread is None:
                 self.__rpm_thread_event.set()
-                self.__rpm_thread.join()
+                self.__rpm_thread.join(timeout)
+                if self.__rpm_thread.is_alive():
+                    logger.warning('Rpm thread did not stop in time.')
 
             self.set_pwm_enable(False)
 
@@ -137,6 +150,37 @@ class Fan():
         return self.__rpm_value
 
 
+    def rpm_open(self) -> int:
+        """Arm rising edge notification on the tach gpio and return its value fd."""
+        if self.__rpm is None:
+            return None
+
+        with open(f'{self.__rpm}/edge','w') as edge:
+            edge.write('rising')
+        fd = os.open(f'{self.__rpm}/value',os.O_RDONLY)
+        os.read(fd,2)
+        self.__pulses = 0
+        return fd
+
+
+    def rpm_edge(self, fd: int):
+        # The value must be re-read from the start to re-arm the notification.
+        os.lseek(fd,0,os.SEEK_SET)
+        os.read(fd,2)
+        self.__pulses += 1
+
+
+    def rpm_update(self, period: float):
+        """Convert the edges counted over the last period seconds to rpm."""
+        self.__rpm_value = int(self.__pulses * 60 / (PULSES_PER_REV * period))
+        self.__pulses = 0
+
+
+    def rpm_close(self, fd: int):
+        os.close(fd)
+        self.__rpm_value = None
+
+
     def set_pwm_enable(self, enable: bool):
         if not self.__pwm is None:
             try:
@@ -175,7 +219,7 @@ class Fan():
                 with open(f'{self.__rpm}/value','r') as gpio:
                     last_pin_state = gpio.read().strip()
 
-                while (round(0.5 - (time.monotonic() - time_in),3) > 0):
+                while (round(0.5 - (time.monotonic() - time_in),3) > 0) and not self.__rpm_thread_event.is_set():
                     with open(f'{self.__rpm}/value','r') as gpio:
                         pin_state = gpio.read().strip()
 
@@ -192,4 +236,4 @@ class Fan():
                 logger.critical(e)
                 self.__rpm_value = None
 
-            time.sleep(0.5)
+            self.__rpm_thread_event.wait(0.5)
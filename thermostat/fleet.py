@@ -0,0 +1,365 @@
+"""Fleet aggregation gateway for many thermostats.
+
+    python -m thermostat.fleet [the daemon's usual command line options]
+
+Subscribes with wildcards to the units' status topics, which also carry
+their action replies, and keeps the latest state of every unit in a
+columnar table. Rollups for the whole fleet and for each configured group
+are published on <fleet-topic>/rollup every rollup-period seconds, so
+dashboards subscribe to one topic instead of to every unit.
+
+A put-settings sent to <fleet-topic>/action with a 'group' is fanned out
+to the action topic of every unit in that group.
+
+Configuration comes from a 'fleet' section:
+
+    fleet:
+      topic: fleet
+      subscribe: ['+/thermostat', '+/thermostat/+']
+      rollup-period: 60
+      stale-after: 300
+      groups:
+        upstairs: ['house1/thermostat/*', 'house2/thermostat/*']
+"""
+import array
+import fnmatch
+import itertools
+import json
+import operator
+import os
+import signal
+import threading
+import time
+
+from project_common import cli
+from project_common import logger
+from project_common.mqtt import Mqtt, mqtt
+
+from . import control
+from . import relays
+from . import settings
+from .control import BACKFILL, RAW
+from .publisher import Publisher, PRIORITY_HIGH, PRIORITY_STATUS
+from .scheduler import Scheduler
+from .settings import Settings
+
+
+COMMON = 'common'
+LOGGER = 'logger'
+FLEET = 'fleet'
+TOPIC = 'topic'
+SUBSCRIBE = 'subscribe'
+GROUPS = 'groups'
+GROUP = 'group'
+ROLLUP_PERIOD = 'rollup-period'
+STALE_AFTER = 'stale-after'
+
+TOPIC_DEFAULT = 'fleet'
+SUBSCRIBE_DEFAULT = ('+/thermostat', '+/thermostat/+')
+ROLLUP_PERIOD_DEFAULT = 60
+STALE_AFTER_DEFAULT = 300
+
+ROLLUP = 'rollup'
+ROLLUP_KEY = 'fleet-rollup'
+UNITS = 'units'
+STALE = 'stale'
+
+# Subtopics of a unit that do not carry status.
+SKIP = frozenset([Settings.ACTION, RAW, BACKFILL])
+
+# Enumerated columns are stored as small integer codes.
+STATES = (control.STATE_IDLE, control.MODE_HEAT, control.MODE_COOL)
+OUTPUTS = tuple(relays.RELAY_STATUS_STR[status] for status in sorted(relays.RELAY_STATUS_STR))
+MODES = (control.MODE_OFF, control.MODE_AUTO, control.MODE_HEAT, control.MODE_COOL)
+FANS = (control.MODE_AUTO, control.MODE_ON)
+UNKNOWN = -1
+
+
+def _code(values: tuple, value) -> int:
+    try:
+        return values.index(value)
+    except ValueError:
+        return UNKNOWN
+
+
+def _gather(rows: array.array):
+    # One itemgetter call gathers every row, but it returns a bare value for a single row.
+    if rows is None:
+        return lambda values: values
+    if len(rows) == 0:
+        return lambda values: ()
+    getter = operator.itemgetter(*rows)
+    if len(rows) == 1:
+        return lambda values: (getter(values),)
+    return getter
+
+
+class Table():
+    """The latest state of every unit, one typed array per field.
+
+    A unit is a row; rows are only ever appended. Rollups run over whole
+    columns at a time rather than walking per-unit records.
+
+    Code columns are masked and counted a whole column at a time, as bytes
+    and as big integers. Without numpy (not a dependency here) the float
+    columns still take one pass per element, through C callables: the
+    staleness compare and the compress of the live readings. A group's
+    columns are gathered out first.
+    """
+    def __init__(self):
+        self.__rows = {}
+        self.units = []
+        self.temperature = array.array('d')
+        self.humidity = array.array('d')
+        self.state = array.array('b')
+        self.output = array.array('b')
+        self.fan_state = array.array('b')
+        self.out_of_service = array.array('b')
+        self.updated = array.array('d')
+        self.mode = array.array('b')
+        self.heat = array.array('d')
+        self.cool = array.array('d')
+        self.fan = array.array('b')
+
+
+    def has(self, unit: str) -> bool:
+        return unit in self.__rows
+
+
+    def row(self, unit: str) -> int:
+        row = self.__rows.get(unit)
+        if row is None:
+            row = len(self.units)
+            self.__rows[unit] = row
+            self.units.append(unit)
+            for column in (self.temperature, self.humidity, self.updated, self.heat, self.cool):
+                column.append(float('nan'))
+            for column in (self.state, self.output, self.fan_state, self.mode, self.fan):
+                column.append(UNKNOWN)
+            self.out_of_service.append(1)
+        return row
+
+
+    def update_status(self, unit: str, status: dict):
+        row = self.row(unit)
+        self.temperature[row] = float(status[control.TEMPERATURE])
+        self.humidity[row] = float(status[control.HUMIDITY])
+        self.state[row] = _code(STATES,status[control.STATE])
+        self.output[row] = _code(OUTPUTS,status[control.OUTPUT])
+        self.fan[row] = _code(FANS,status[control.FAN])
+        self.fan_state[row] = _code(OUTPUTS,status[control.FAN_STATE])
+        self.out_of_service[row] = 0
+        self.updated[row] = time.time()
+
+
+    def update_out_of_service(self, unit: str):
+        row = self.row(unit)
+        self.out_of_service[row] = 1
+        self.updated[row] = time.time()
+
+
+    def update_settings(self, unit: str, result: dict):
+        row = self.row(unit)
+        self.mode[row] = _code(MODES,result.get(settings.MODE))
+        if isinstance(result.get(control.MODE_HEAT),(int, float)):
+            self.heat[row] = float(result[control.MODE_HEAT])
+        if isinstance(result.get(control.MODE_COOL),(int, float)):
+            self.cool[row] = float(result[control.MODE_COOL])
+
+
+    def update_fan(self, unit: str, result: str):
+        self.fan[self.row(unit)] = _code(FANS,result)
+
+
+    def rollup(self, rows: array.array, stale_after: float) -> dict:
+        """Summarise the given rows, or every row when rows is None."""
+        oldest = time.time() - stale_after
+
+        count = len(self.units) if rows is None else len(rows)
+        column = _gather(rows)
+
+        def codes(values: array.array) -> int:
+            # A code column as one integer, a byte per row, so masks apply to all rows at once.
+            return int.from_bytes((values if rows is None else array.array('b',column(values))).tobytes(),'little')
+
+        # A byte per row: 1 where heard from since oldest, then where also in service.
+        fresh = int.from_bytes(bytes(map(operator.ge,column(self.updated),itertools.repeat(oldest))),'little')
+        oos = codes(self.out_of_service)
+        mask = fresh & ~oos
+        # 0xff over the rows that are not live, which matches no code.
+        dead = (mask ^ int.from_bytes(b'\x01' * count,'little')) * 0xff
+
+        def histogram(values: array.array, names: tuple, mask: int) -> dict:
+            counts = (codes(values) | mask).to_bytes(count,'little')
+            return {name: counts.count(code) for (code, name) in enumerate(names)}
+
+        live = mask.to_bytes(count,'little')
+        temperature = list(itertools.compress(column(self.temperature),live))
+        humidity = list(itertools.compress(column(self.humidity),live))
+
+        out_of_service = oos.to_bytes(count,'little').count(1)
+        rollup = {
+            UNITS: count,
+            control.OOS: out_of_service,
+            STALE: count - out_of_service - live.count(1),
+            control.STATE: histogram(self.state,STATES,dead),
+            control.OUTPUT: histogram(self.output,OUTPUTS,dead),
+            control.FAN: histogram(self.fan,FANS,dead),
+            control.FAN_STATE: histogram(self.fan_state,OUTPUTS,dead),
+            settings.MODE: histogram(self.mode,MODES,0),
+        }
+        if len(temperature) != 0:
+            rollup[control.TEMPERATURE] = {'mean': round(sum(temperature) / len(temperature),3), 'min': min(temperature), 'max': max(temperature)}
+            rollup[control.HUMIDITY] = {'mean': round(sum(humidity) / len(humidity),1), 'min': min(humidity), 'max': max(humidity)}
+        return rollup
+
+
+class Fleet():
+    def __init__(self, config: dict):
+        fleet = config.get(FLEET,{}) if not config is None else {}
+        root = config.get(COMMON,{}).get('topic-root') if not config is None else None
+
+        self.__topic = fleet.get(TOPIC,TOPIC_DEFAULT if root is None else f'{root}/{TOPIC_DEFAULT}')
+        self.__subscribe = list(fleet.get(SUBSCRIBE,SUBSCRIBE_DEFAULT))
+        self.__groups = dict(fleet.get(GROUPS,{}))
+        self.__rollup_period = fleet.get(ROLLUP_PERIOD,ROLLUP_PERIOD_DEFAULT)
+        self.__stale_after = fleet.get(STALE_AFTER,STALE_AFTER_DEFAULT)
+
+        # Messages arrive on the MQTT thread, rollups run on the scheduler.
+        self.__lock = threading.Lock()
+        self.__table = Table()
+        # group -> rows, worked out as units appear
+        self.__members = {group: array.array('l') for group in self.__groups}
+
+
+    def start(self):
+        Mqtt.instance().register_on_connect(self.__on_connect)
+        Scheduler.instance().every(ROLLUP_KEY,self.__rollup_period,self.__publish_rollup)
+
+
+    def __on_connect(self, client, userdata, flags, rc):
+        if rc != mqtt.client.CONNACK_ACCEPTED:
+            return
+        for sub in self.__subscribe:
+            logger.logger.info(f'Subscribing to {sub}')
+            Mqtt.instance().subscribe(sub,qos=1)
+            Mqtt.instance().message_callback_add(sub,self.__on_unit_message)
+        action = f'{self.__topic}/{Settings.ACTION}'
+        Mqtt.instance().subscribe(action,qos=2)
+        Mqtt.instance().message_callback_add(action,self.__on_action)
+
+
+    def __on_unit_message(self, client, userdata, message):
+        unit = message.topic
+        if os.path.basename(unit) in SKIP or unit.startswith(f'{self.__topic}/') or unit == self.__topic:
+            return
+
+        # Out-of-service (from the unit or its will) is the bare word, not JSON.
+        if message.payload == control.OOS.encode():
+            payload = control.OOS
+        else:
+            try:
+                payload = json.loads(message.payload)
+            except ValueError:
+                return
+
+        with self.__lock:
+            new = not self.__table.has(unit)
+            try:
+                if payload == control.OOS:
+                    self.__table.update_out_of_service(unit)
+                elif isinstance(payload,dict) and control.TEMPERATURE in payload:
+                    self.__table.update_status(unit,payload)
+                else:
+                    # Action replies, alone or in a batch.
+                    for reply in payload if isinstance(payload,list) else [payload]:
+                        self.__update_reply(unit,reply)
+            except (KeyError, TypeError, ValueError) as ex:
+                logger.logger.debug(f'Ignoring malformed message from {unit}: {ex}')
+
+            if new and self.__table.has(unit):
+                row = self.__table.row(unit)
+                for (group, patterns) in self.__groups.items():
+                    if any(fnmatch.fnmatchcase(unit,pattern) for pattern in patterns):
+                        self.__members[group].append(row)
+
+
+    def __update_reply(self, unit: str, reply):
+        if not isinstance(reply,dict):
+            return
+        if reply.get(Settings.CMD) == Settings.CMD_GET_SETTINGS and isinstance(reply.get(Settings.RESULT),dict):
+            self.__table.update_settings(unit,reply[Settings.RESULT])
+        elif reply.get(Settings.CMD) == Settings.CMD_GET_FAN:
+            self.__table.update_fan(unit,reply.get(Settings.RESULT))
+
+
+    def __on_action(self, client, userdata, message):
+        try:
+            command = json.loads(message.payload)
+        except ValueError:
+            logger.logger.warning(f'Received message payload is not valid json: "{message.payload}"')
+            return
+        if not isinstance(command,dict):
+            return
+
+        cmd = command.get(Settings.CMD)
+        group = command.get(GROUP)
+        response = {Settings.CMD: cmd, GROUP: group, Settings.RESULT: Settings.RESULT_FAIL}
+        if cmd == Settings.CMD_PUT_SETTINGS and group in self.__groups and Settings.RESULT in command:
+            with self.__lock:
+                units = [self.__table.units[row] for row in self.__members[group]]
+            # The get-settings that follows keeps the table's settings current.
+            batch = json.dumps([{Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: command[Settings.RESULT]}, {Settings.CMD: Settings.CMD_GET_SETTINGS}])
+            for unit in units:
+                Publisher.instance().publish(f'{unit}/{Settings.ACTION}',batch,priority=PRIORITY_HIGH)
+            logger.logger.info(f'Sent put-settings to {len(units)} units in {group}')
+            response[Settings.RESULT] = Settings.RESULT_OK
+            response[UNITS] = len(units)
+
+        if Settings.ID in command:
+            response[Settings.ID] = command[Settings.ID]
+        Publisher.instance().publish(self.__topic,json.dumps(response),priority=PRIORITY_HIGH)
+
+
+    def __publish_rollup(self):
+        with self.__lock:
+            rollup = self.__table.rollup(None,self.__stale_after)
+            rollup[GROUPS] = {group: self.__table.rollup(rows,self.__stale_after) for (group, rows) in self.__members.items()}
+        Publisher.instance().publish(f'{self.__topic}/{ROLLUP}',json.dumps(rollup),qos=1,priority=PRIORITY_STATUS,key=ROLLUP_KEY)
+
+
+def main():
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        logger.logger.info(f'Caught signal {signum}')
+        stop.set()
+
+    config = cli.parse_command_line_arguments()
+    logger_config = None
+    if not config is None:
+        logger_config = config.get(COMMON) if LOGGER in config.get(COMMON,{}) else config.get(FLEET,{}).get(LOGGER)
+    logger.parse_logger_config(logger_config,appname='thermostat-fleet')
+
+    fleet = Fleet(config)
+    Mqtt({'mqtt': {'clientid': 'thermostat-fleet'}})
+    Publisher()
+    Scheduler()
+
+    signal.signal(signal.SIGINT,on_signal)
+    signal.signal(signal.SIGTERM,on_signal)
+
+    fleet.start()
+    Mqtt.instance().connect()
+    logger.logger.info('thermostat fleet is started')
+
+    stop.wait()
+
+    Scheduler.instance().stop()
+    Publisher.instance().stop()
+    Mqtt.instance().disconnect()
+    logger.logger.info('thermostat fleet is stopped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import threading
+
+from project_common.logger import logger
+
+
+# Stack reserved for each thread in low-memory mode. Ample for the daemon's
+# shallow call chains; the default is usually 8MiB.
+THREAD_STACK_SIZE = 256 * 1024
+
+MIB = 1024 * 1024
+
+
+def status(field: str) -> int:
+    """A memory figure from /proc/self/status in bytes, or None where it is not available."""
+    try:
+        with open('/proc/self/status','r') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss() -> int:
+    return status('VmRSS')
+
+
+def limit_stacks():
+    """Shrink the stack of every thread started from now on. Call before any are started."""
+    threading.stack_size(THREAD_STACK_SIZE)
+
+
+def report(target: int = None):
+    """Log the daemon's memory footprint, warning when RSS is over target bytes."""
+    current = rss()
+    if current is None:
+        return
+
+    peak = status('VmHWM')
+    stack = threading.stack_size()
+    logger.info(f'Memory: RSS {current / MIB:.1f}MiB (peak {peak / MIB:.1f}MiB), {threading.active_count()} threads with {"default" if stack == 0 else f"{stack // 1024}KiB"} stacks')
+    if not target is None and current > target:
+        logger.warning(f'RSS {current / MIB:.1f}MiB is over the {target / MIB:.1f}MiB target.')
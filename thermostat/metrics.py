@@ -0,0 +1,137 @@
+import http.server
+import threading
+
+from project_common.logger import logger
+
+
+# Metric indexes into the preallocated value table.
+CONTROL_TICKS = 0
+CONTROL_TICK_SECONDS = 1
+CONTROL_TICK_LAST_SECONDS = 2
+CONTROL_TICK_OVERRUNS = 3
+SENSOR_TIMEOUTS = 4
+SENSOR_SHORT_READS = 5
+SENSOR_OPEN_ERRORS = 6
+RELAY_ERRORS = 7
+RELAY_RESETS = 8
+FAN_RPM = 9
+MQTT_PUBLISHES = 10
+MQTT_PUBLISH_FAILURES = 11
+SETTINGS_WRITES = 12
+SETTINGS_WRITE_SECONDS = 13
+SETTINGS_WRITE_LAST_SECONDS = 14
+RAW_BATCHES = 15
+RAW_SAMPLES_DROPPED = 16
+MQTT_QUEUE_DROPPED = 17
+BACKFILL_DROPPED = 18
+ACTION_DROPPED = 19
+ACTION_THROTTLED = 20
+ACTION_SUPERSEDED = 21
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+# (name, type, help) in index order. Zones share one set, so each metric
+# covers every zone.
+METRICS = (
+    ('thermostat_control_ticks_total', COUNTER, 'Control ticks run, across all zones.'),
+    ('thermostat_control_tick_seconds_total', COUNTER, 'Time spent in control ticks, across all zones.'),
+    ('thermostat_control_tick_last_seconds', GAUGE, 'Duration of the most recent control tick of any zone.'),
+    ('thermostat_control_tick_overruns_total', COUNTER, 'Control ticks that took longer than their period, across all zones.'),
+    ('thermostat_sensor_timeouts_total', COUNTER, 'Sensor reads that timed out, across all zones.'),
+    ('thermostat_sensor_short_reads_total', COUNTER, 'Sensor reads that returned too little data, across all zones.'),
+    ('thermostat_sensor_open_errors_total', COUNTER, 'Failures to open or configure a sensor, across all zones.'),
+    ('thermostat_relay_errors_total', COUNTER, 'Relay controller I2C errors, across all zones.'),
+    ('thermostat_relay_resets_total', COUNTER, 'Relay controller resets reported through MCUSR, across all zones.'),
+    ('thermostat_fan_rpm', GAUGE, 'Board fan speed.'),
+    ('thermostat_mqtt_publishes_total', COUNTER, 'MQTT publishes attempted.'),
+    ('thermostat_mqtt_publish_failures_total', COUNTER, 'MQTT publishes that failed.'),
+    ('thermostat_settings_writes_total', COUNTER, 'Settings file writes, across all zones.'),
+    ('thermostat_settings_write_seconds_total', COUNTER, 'Time spent writing settings files, across all zones.'),
+    ('thermostat_settings_write_last_seconds', GAUGE, 'Duration of the most recent settings file write of any zone.'),
+    ('thermostat_raw_batches_total', COUNTER, 'Raw sample batches published.'),
+    ('thermostat_raw_samples_dropped_total', COUNTER, 'Raw samples dropped because their batch was full.'),
+    ('thermostat_mqtt_queue_dropped_total', COUNTER, 'Outbound messages dropped because the publish queue was full.'),
+    ('thermostat_backfill_dropped_total', COUNTER, 'Status changes lost because the outage buffer was full.'),
+    ('thermostat_action_dropped_total', COUNTER, 'Action messages dropped for being too large or arriving to a full queue.'),
+    ('thermostat_action_throttled_total', COUNTER, 'Action messages dropped by a client\'s rate limit.'),
+    ('thermostat_action_superseded_total', COUNTER, 'Queued put-settings dropped for a newer one that replaces them.'),
+)
+
+# How often the server checks for shutdown.
+POLL_INTERVAL = 0.1
+
+# Allocated once; the hot paths only index into it.
+_values = [0.0] * len(METRICS)
+
+
+def inc(metric: int, amount: float = 1):
+    _values[metric] += amount
+
+
+def gauge(metric: int, value: float):
+    _values[metric] = value
+
+
+def value(metric: int) -> float:
+    return _values[metric]
+
+
+def render() -> str:
+    lines = []
+    for (i, (name, kind, help)) in enumerate(METRICS):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        # repr keeps every digit, so large counters still step by one.
+        lines.append(f'{name} {_values[i]!r}')
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        logger.debug(f'metrics: {format % args}')
+
+
+class Metrics():
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if Metrics.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return Metrics.__instance
+
+
+    def __init__(self, port: int):
+        if Metrics.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        # Loopback only; the endpoint is for a local scraper or agent.
+        self.__server = http.server.HTTPServer(('127.0.0.1',port),_Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever,args=(POLL_INTERVAL,),name='metrics')
+        self.__thread.start()
+
+        logger.info(f'Serving metrics on 127.0.0.1:{port}')
+
+        Metrics.__instance = self
+
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
@@ -0,0 +1,158 @@
+import collections
+import threading
+
+from project_common.logger import logger
+from project_common.mqtt import Mqtt, mqtt
+
+from . import metrics
+
+
+# Priorities, most urgent first.
+PRIORITY_HIGH = 0   # out-of-service and command replies
+PRIORITY_STATUS = 1
+PRIORITY_LOW = 2    # bulk data that is fine to shed first
+PRIORITIES = 3
+
+QUEUE_SIZE = 64
+
+# Entry fields: [topic, payload, qos, properties, key, priority, live]
+_PRIORITY = 5
+_LIVE = 6
+
+
+class Publisher():
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if Publisher.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return Publisher.__instance
+
+
+    def __init__(self, size: int = QUEUE_SIZE):
+        """Publishes to the broker from a dedicated 'publisher' thread.
+
+        publish() only queues, so a slow or congested broker holds up this
+        thread and never the control tick or the MQTT callbacks. The queue
+        holds at most size messages; when it is full the least urgent, oldest
+        message is dropped.
+        """
+        if Publisher.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        self.__size = size
+        self.__queues = [collections.deque() for _ in range(PRIORITIES)]
+        # key -> queued entry that a newer message with the same key replaces
+        self.__keyed = {}
+        self.__count = 0
+        self.__running = True
+        self.__on_sent = []
+
+        self.__cond = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run,name='publisher')
+        self.__thread.start()
+
+        Publisher.__instance = self
+
+
+    def stop(self, timeout: float = None):
+        """Send what is still queued, but not past the timeout."""
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+        self.__thread.join(timeout)
+        if self.__thread.is_alive():
+            logger.warning(f'Publisher did not drain in time, {self.__count} messages not sent.')
+
+
+    def register_on_sent(self, callback):
+        """Call callback(topic, payload) on the publisher thread for each message the client took."""
+        self.__on_sent.append(callback)
+
+
+    def publish(self, topic: str, payload, qos: int = 2, priority: int = PRIORITY_STATUS, key: str = None, properties=None) -> bool:
+        """Queue a message. Returns False if it was dropped.
+
+        A message with a key supersedes one with the same key that has not
+        been sent yet, so a stale status never goes out after a newer one.
+        """
+        with self.__cond:
+            entry = None if key is None else self.__keyed.get(key)
+            if not entry is None:
+                if entry[_PRIORITY] == priority:
+                    # Takes the stale message's place in the queue.
+                    entry[:_PRIORITY] = [topic, payload, qos, properties, key]
+                    return True
+                self.__forget(entry)
+
+            if self.__count >= self.__size and not self.__shed(priority):
+                metrics.inc(metrics.MQTT_QUEUE_DROPPED)
+                return False
+
+            entry = [topic, payload, qos, properties, key, priority, True]
+            self.__queues[priority].append(entry)
+            if not key is None:
+                self.__keyed[key] = entry
+            self.__count += 1
+            self.__cond.notify()
+            return True
+
+
+    def __shed(self, priority: int) -> bool:
+        # Drop the oldest queued message that is no more urgent than the new one.
+        for queue in reversed(self.__queues[priority:]):
+            while len(queue) != 0:
+                entry = queue.popleft()
+                if entry[_LIVE]:
+                    self.__forget(entry)
+                    metrics.inc(metrics.MQTT_QUEUE_DROPPED)
+                    return True
+        return False
+
+
+    def __forget(self, entry: list):
+        (_, _, _, _, key, _, _) = entry
+        entry[_LIVE] = False
+        self.__count -= 1
+        if not key is None and self.__keyed.get(key) is entry:
+            del self.__keyed[key]
+
+
+    def __pop(self) -> list:
+        for queue in self.__queues:
+            while len(queue) != 0:
+                entry = queue.popleft()
+                if entry[_LIVE]:
+                    self.__forget(entry)
+                    return entry
+        return None
+
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                entry = self.__pop()
+                while entry is None:
+                    if not self.__running:
+                        return
+                    self.__cond.wait()
+                    entry = self.__pop()
+
+            (topic, payload, qos, properties, _, _, _) = entry
+            metrics.inc(metrics.MQTT_PUBLISHES)
+            try:
+                if properties is None:
+                    info = Mqtt.instance().publish(topic,payload=payload,qos=qos)
+                else:
+                    info = Mqtt.instance().publish(topic,payload=payload,qos=qos,properties=properties)
+                if getattr(info,'rc',mqtt.client.MQTT_ERR_SUCCESS) != mqtt.client.MQTT_ERR_SUCCESS:
+                    metrics.inc(metrics.MQTT_PUBLISH_FAILURES)
+                else:
+                    for callback in self.__on_sent:
+                        callback(topic,payload)
+            except Exception as ex:
+                metrics.inc(metrics.MQTT_PUBLISH_FAILURES)
+                logger.warning(ex)
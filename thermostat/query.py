@@ -0,0 +1,192 @@
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from project_common.logger import logger
+
+from . import control
+from . import metrics
+from .control import Control
+from .settings import Settings
+
+
+ZONE = 'zone'
+
+CMD_GET_STATUS = 'get-status'
+CMD_GET_HEALTH = 'get-health'
+CMD_SUBSCRIBE = 'subscribe'
+
+# Status changes a slow subscriber may fall behind by before they are dropped for it.
+SUBSCRIBER_QUEUE = 64
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # One JSON request per line, answered by one JSON line.
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.__write({Settings.CMD: None, Settings.RESULT: Settings.RESULT_FAIL})
+                continue
+
+            if isinstance(request,dict) and request.get(Settings.CMD) == CMD_SUBSCRIBE:
+                self.__stream(self.server.query.subscribe())
+                return
+
+            if not self.__write(self.server.query.answer(request)):
+                return
+
+
+    def __stream(self, subscription: queue.Queue):
+        try:
+            while True:
+                message = subscription.get()
+                if message is None or not self.__write(message):
+                    return
+        finally:
+            self.server.query.unsubscribe(subscription)
+
+
+    def __write(self, message: dict) -> bool:
+        try:
+            self.wfile.write(json.dumps(message).encode() + b'\n')
+            self.wfile.flush()
+            return True
+        except OSError:
+            return False
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Query():
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if Query.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return Query.__instance
+
+
+    def __init__(self, path: str):
+        """Answers status, settings, fan and health queries on a Unix socket.
+
+        Answers come from the state already held in memory by Control and
+        Settings, so co-located consumers neither load the broker nor depend
+        on it. A 'subscribe' request turns the connection into a stream of
+        status changes. Create it after the zones' Control and Settings.
+        """
+        if Query.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        self.__path = path
+        self.__time_in = time.monotonic()
+        self.__lock = threading.Lock()
+        self.__subscriptions = set()
+
+        for ctl in Control.instances():
+            ctl.register_on_status(self.__on_status)
+
+        # A socket left behind by an unclean exit would stop the bind.
+        if os.path.exists(path):
+            os.unlink(path)
+        self.__server = _Server(path,_Handler)
+        self.__server.query = self
+        self.__thread = threading.Thread(target=self.__server.serve_forever,args=(metrics.POLL_INTERVAL,),name='query')
+        self.__thread.start()
+
+        logger.info(f'Answering queries on {path}')
+
+        Query.__instance = self
+
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        with self.__lock:
+            for subscription in self.__subscriptions:
+                # Drop a message to make room for the end of a full stream.
+                try:
+                    subscription.get_nowait()
+                except queue.Empty:
+                    pass
+                subscription.put_nowait(None)
+        self.__thread.join()
+        try:
+            os.unlink(self.__path)
+        except OSError:
+            pass
+
+
+    def answer(self, request) -> dict:
+        cmd = request.get(Settings.CMD) if isinstance(request,dict) else None
+        try:
+            zone = request.get(ZONE)
+            if cmd == CMD_GET_STATUS:
+                response = {Settings.CMD: cmd, Settings.RESULT: self.__status(Control.instance(zone).status())}
+            elif cmd == CMD_GET_HEALTH:
+                response = {Settings.CMD: cmd, Settings.RESULT: self.__health()}
+            else:
+                response = Settings.instance(zone).query(request)
+                if response is None:
+                    response = {Settings.CMD: cmd, Settings.RESULT: Settings.RESULT_FAIL}
+        except Exception as ex:
+            logger.debug(ex)
+            response = {Settings.CMD: cmd, Settings.RESULT: Settings.RESULT_FAIL}
+
+        if isinstance(request,dict) and Settings.ID in request:
+            response[Settings.ID] = request[Settings.ID]
+        return response
+
+
+    def subscribe(self) -> queue.Queue:
+        """Start a stream of status changes, beginning with each zone's current status."""
+        subscription = queue.Queue(SUBSCRIBER_QUEUE)
+        with self.__lock:
+            for ctl in Control.instances():
+                subscription.put_nowait(self.__message(ctl.zone(),ctl.status()))
+            self.__subscriptions.add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, subscription: queue.Queue):
+        with self.__lock:
+            self.__subscriptions.discard(subscription)
+
+
+    def __on_status(self, zone: str, status: dict):
+        message = self.__message(zone,status)
+        with self.__lock:
+            for subscription in self.__subscriptions:
+                try:
+                    subscription.put_nowait(message)
+                except queue.Full:
+                    pass
+
+
+    def __message(self, zone: str, status: dict) -> dict:
+        return {Settings.CMD: CMD_SUBSCRIBE, ZONE: zone, Settings.RESULT: self.__status(status)}
+
+
+    def __status(self, status: dict):
+        return control.OOS if status is None else status
+
+
+    def __health(self) -> dict:
+        return {
+            'uptime': round(time.monotonic() - self.__time_in,3),
+            'zones': [{ZONE: ctl.zone(), control.OOS: ctl.status() is None, 'connected': ctl.connected()} for ctl in Control.instances()],
+            'tick-last-seconds': metrics.value(metrics.CONTROL_TICK_LAST_SECONDS),
+            'tick-overruns': metrics.value(metrics.CONTROL_TICK_OVERRUNS),
+            'sensor-timeouts': metrics.value(metrics.SENSOR_TIMEOUTS),
+            'relay-errors': metrics.value(metrics.RELAY_ERRORS),
+            'publish-failures': metrics.value(metrics.MQTT_PUBLISH_FAILURES),
+        }
@@ -1,5 +1,6 @@
 import fcntl
 import os
+import threading
 
 
 I2C_SLAVE = 0x0703  # Use this slave address
@@ -27,61 +28,132 @@ RELAY_NAME_STR = {RELAY_FAN: 'fan', RELAY_COOL: 'cool', RELAY_HEAT: 'heat'}
 RELAY_STATUS_STR = {RELAY_STATUS_OFF: 'off', RELAY_STATUS_ON: 'on', RELAY_STATUS_LOCKED: 'locked'}
 
 
-class Relays():
-    def __init__(self,i2c: str, addr: int):
-        self.__device = f'/dev/{i2c}'
-        self.__addr = addr
+def _exchange(fd: int, data: bytes, length: int) -> bytes:
+    if not data is None:
+        os.write(fd,data)
+    if length != 0:
+        return os.read(fd,length)
+    return None
+
+
+class Bus():
+    # One fd per I2C adapter; each transfer selects its slave address under the lock,
+    # so relay boards of several zones share it.
+    __buses = {}
+    __buses_lock = threading.Lock()
+
+    __slots__ = ('__device', '__fd', '__addr', '__lock')
+
+
+    @staticmethod
+    def get(i2c: str):
+        with Bus.__buses_lock:
+            if not i2c in Bus.__buses:
+                Bus.__buses[i2c] = Bus(f'/dev/{i2c}')
+            return Bus.__buses[i2c]
+
+
+    def __init__(self, device: str):
+        self.__device = device
         self.__fd = None
+        self.__addr = None
+        self.__lock = threading.Lock()
 
 
     def open(self):
+        with self.__lock:
+            self.__open()
+
+
+    def close(self, timeout: float = None):
+        # A transfer still holding the bus past the timeout keeps the fd.
+        if not self.__lock.acquire(timeout=-1 if timeout is None else timeout):
+            return
+        try:
+            if not self.__fd is None:
+                os.close(self.__fd)
+                self.__fd = None
+                self.__addr = None
+        finally:
+            self.__lock.release()
+
+
+    def transfer(self, addr: int, data: bytes = None, length: int = 0, timeout: float = None) -> bytes:
+        """Write data (if any) then read length bytes (if any) from addr."""
+        # Past the timeout, go out on an fd of its own rather than wait behind a stuck transfer.
+        if not self.__lock.acquire(timeout=-1 if timeout is None else timeout):
+            return self.__transfer_alone(addr,data,length)
+        try:
+            self.__open()
+            if self.__addr != addr:
+                if fcntl.ioctl(self.__fd,I2C_SLAVE,addr) != 0:
+                    os.close(self.__fd)
+                    self.__fd = None
+                    raise IOError(f'Could net set slave address to 0x{addr:#02X}')
+                self.__addr = addr
+            return _exchange(self.__fd,data,length)
+        finally:
+            self.__lock.release()
+
+
+    def __transfer_alone(self, addr: int, data: bytes, length: int) -> bytes:
+        fd = os.open(self.__device,os.O_RDWR)
+        try:
+            if fcntl.ioctl(fd,I2C_SLAVE,addr) != 0:
+                raise IOError(f'Could net set slave address to 0x{addr:#02X}')
+            return _exchange(fd,data,length)
+        finally:
+            os.close(fd)
+
+
+    def __open(self):
         if self.__fd is None:
             self.__fd = os.open(self.__device,os.O_RDWR)
-            if fcntl.ioctl(self.__fd,I2C_SLAVE,self.__addr) != 0:
-                self.close()
-                raise IOError(f'Could net set slave address to 0x{self.__addr:#02X}')
+            self.__addr = None
+
+
+class Relays():
+    __slots__ = ('__bus', '__addr')
+
+
+    def __init__(self,i2c: str, addr: int):
+        self.__bus = Bus.get(i2c)
+        self.__addr = addr
+
+
+    def open(self):
+        self.__bus.open()
 
 
-    def close(self):
-        if not self.__fd is None:
-            os.close(self.__fd)
-            self.__fd = None
+    def close(self, timeout: float = None):
+        self.__bus.close(timeout)
 
 
     def get_status(self) -> bytearray:
-        self.open()
-        return os.read(self.__fd,4)
+        return self.__bus.transfer(self.__addr,length=4)
 
 
     def reset_mcusr(self) -> int:
-        self.open()
         mcusr = bytearray(b'\x0f\x00\x00\x00')
-        os.write(self.__fd,mcusr)
-        return self.get_mcusr()
+        return self.__bus.transfer(self.__addr,mcusr,4)[MCUSR]
 
 
     def get_mcusr(self) -> int:
-        self.open()
         return self.get_status()[MCUSR]
 
 
     def relay_on(self,relay: int) -> int:
-        self.open()
         packet = bytearray(b'\x00\x00\x00\x00')
         packet[relay] = RELAY_ON
-        os.write(self.__fd,packet)
-        return self.get_status()[relay]
+        return self.__bus.transfer(self.__addr,packet,4)[relay]
 
 
     def relay_off(self,relay: int) -> int:
-        self.open()
         packet = bytearray(b'\x00\x00\x00\x00')
         packet[relay] = RELAY_OFF
-        os.write(self.__fd,packet)
-        return self.get_status()[relay]
+        return self.__bus.transfer(self.__addr,packet,4)[relay]
 
 
-    def relay_all_off(self) -> bytearray:
-        self.open()
-        os.write(self.__fd,bytearray(b'\x00\x01\x01\x01'))
-        return self.get_status()
+    def relay_all_off(self, timeout: float = None) -> bytearray:
+        """Turn every relay off, on a separate fd if the bus is not free within timeout."""
+        return self.__bus.transfer(self.__addr,bytearray(b'\x00\x01\x01\x01'),4,timeout)
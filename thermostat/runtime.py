@@ -0,0 +1,184 @@
+import asyncio
+import concurrent.futures
+import select
+import signal
+import time
+
+from project_common.logger import logger
+from project_common.mqtt import Mqtt
+
+from . import memory
+from . import metrics
+from . import sht3x
+from . import startup
+from .config import Config
+from .control import Control
+from .publisher import Publisher
+from .query import Query
+from .scheduler import Scheduler
+from .settings import Settings
+
+
+RPM_PERIOD = 1.0
+SENSOR_RETRY = 1.0
+
+
+class Runtime():
+    def __init__(self, reload):
+        """Runs the thermostat on one asyncio event loop.
+
+        Sensor reads and tach edges are driven by their file descriptors
+        being registered with the loop (the tach through an epoll set), and
+        the control tick, settings debounce and persistence run from a loop
+        backed Scheduler. Blocking device access (ioctls, I2C transfers, file
+        writes) is handed to a single worker executor. MQTT network I/O stays on the client's own
+        thread; its callbacks reach the loop through the scheduler.
+
+        reload() is called off the loop when SIGHUP is received.
+        """
+        self.__reload = reload
+        self.__stop = None
+
+
+    def run(self):
+        asyncio.run(self.__main())
+
+
+    async def __main(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix='io'))
+
+        self.__stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT,self.__on_signal,signal.SIGINT)
+        loop.add_signal_handler(signal.SIGHUP,self.__on_hangup)
+
+        Scheduler(loop)
+        for zone in Config.instance().zones():
+            with startup.step('zone' if zone.zone() is None else f'zone/{zone.zone()}'):
+                Control(zone)
+                Settings(zone)
+        startup.log_first_status(Publisher.instance(),[zone.topic() for zone in Config.instance().zones()])
+
+        # The connection comes up on its own thread while the hardware does.
+        connect = startup.Background('connect',Mqtt.instance().connect)
+        for control in Control.instances():
+            control.open()
+
+        # Every zone's sensor shares the loop; the board fan is counted once.
+        tasks = [loop.create_task(self.__sensor(control.sht())) for control in Control.instances()]
+        tasks.append(loop.create_task(self.__tach(Control.instances()[0].fan())))
+
+        # Answered on its own threads from the same in-memory state.
+        query_server = None
+        if not Config.instance().query_socket() is None:
+            query_server = Query(Config.instance().query_socket())
+
+        for control in Control.instances():
+            control.start()
+        connect.join()
+
+        logger.info('thermostat is started')
+        startup.report()
+        memory.report(Config.instance().rss_target())
+
+        await self.__stop.wait()
+
+        logger.info('thermostat is stopping')
+
+        time_in = time.monotonic()
+        deadline = time_in + Config.instance().shutdown_timeout()
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks,return_exceptions=True)
+
+        if not query_server is None:
+            query_server.stop()
+
+        for settings in Settings.instances():
+            settings.stop()
+        Scheduler.instance().stop()
+        try:
+            await asyncio.wait_for(Scheduler.instance().join(),max(deadline - time.monotonic(),0.0))
+        except asyncio.TimeoutError:
+            logger.warning('Scheduler did not stop in time.')
+        # Called on the loop thread so a tick stuck in the executor cannot hold up the relays.
+        for control in Control.instances():
+            control.stop(max(deadline - time.monotonic(),0.0))
+        Publisher.instance().stop(max(deadline - time.monotonic(),0.0))
+        Mqtt.instance().disconnect()
+
+        logger.info(f'thermostat is stopped in {time.monotonic() - time_in:1.3f}s')
+
+
+    def __on_signal(self, signum: int):
+        logger.info(f'Caught signal {signum}')
+        self.__stop.set()
+
+
+    def __on_hangup(self):
+        logger.info(f'Caught signal {signal.SIGHUP}')
+        asyncio.get_running_loop().run_in_executor(None,self.__reload)
+
+
+    async def __sensor(self, sht: sht3x.Sht3x):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                fd = await loop.run_in_executor(None,sht.open)
+            except Exception as ex:
+                metrics.inc(metrics.SENSOR_OPEN_ERRORS)
+                logger.critical(ex)
+                await asyncio.sleep(SENSOR_RETRY)
+                continue
+
+            readable = asyncio.Event()
+            loop.add_reader(fd,readable.set)
+            try:
+                while True:
+                    try:
+                        await asyncio.wait_for(readable.wait(),sht3x.READ_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        metrics.inc(metrics.SENSOR_TIMEOUTS)
+                        raise Exception('Unexpected timeout waiting for sensor data.')
+                    readable.clear()
+                    sht.read(fd)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.critical(ex)
+                sht.reset()
+            finally:
+                loop.remove_reader(fd)
+                sht.close(fd)
+
+
+    async def __tach(self, fan):
+        loop = asyncio.get_running_loop()
+        try:
+            fd = fan.rpm_open()
+        except Exception as ex:
+            logger.critical(ex)
+            return
+        if fd is None:
+            return
+
+        # sysfs gpio signals an edge with POLLPRI|POLLERR, but a sysfs value is
+        # always readable, so the fd cannot go to the loop's reader directly.
+        # An epoll set waiting for the edge alone is readable only on an edge.
+        edges = select.epoll()
+        edges.register(fd,select.EPOLLPRI | select.EPOLLERR)
+        loop.add_reader(edges.fileno(),self.__tach_edges,edges,fan)
+        try:
+            while True:
+                await asyncio.sleep(RPM_PERIOD)
+                fan.rpm_update(RPM_PERIOD)
+        finally:
+            loop.remove_reader(edges.fileno())
+            edges.close()
+            fan.rpm_close(fd)
+
+
+    def __tach_edges(self, edges: select.epoll, fan):
+        for (fd, _) in edges.poll(0):
+            fan.rpm_edge(fd)
@@ -0,0 +1,286 @@
+import bisect
+import datetime
+import json
+import threading
+import time
+
+from project_common.logger import logger
+
+from .scheduler import Scheduler
+
+
+ENABLED = 'enabled'
+WEEKLY = 'weekly'
+HOLIDAYS = 'holidays'
+HOLD = 'hold'
+DAYS = 'days'
+DATE = 'date'
+TIME = 'time'
+EVENTS = 'events'
+UNTIL = 'until'
+DURATION = 'duration'
+SETTINGS = 'settings'
+NEXT = 'next'
+LAST = 'last'
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# The index always covers at least this many days ahead of now.
+INDEX_DAYS = 8
+# Re-evaluate at least this often so wall clock steps (NTP sync after boot) are picked up.
+MAX_SLEEP = 3600.0
+
+
+class Schedule():
+    def __init__(self, path: str, apply, validate, key: str = 'schedule'):
+        """Weekly/holiday setpoint schedule.
+
+        apply(settings) is called with the settings of each transition as it
+        comes due. validate(settings) must raise if an entry's settings are
+        not acceptable.
+        """
+        self.__path = path
+        self.__apply = apply
+        self.__validate = validate
+        self.__key = key
+
+        self.__lock = threading.Lock()
+
+        self.__enabled = False
+        # [(weekday, minute, settings)]
+        self.__weekly = []
+        # date iso string -> [(minute, settings)]
+        self.__holidays = {}
+        # (until, settings) or None
+        self.__hold = None
+
+        # Sorted transition times (epoch seconds) and the settings for each.
+        self.__times = []
+        self.__events = []
+        self.__last = None
+
+        try:
+            with open(self.__path,'r') as f:
+                self.__parse(json.load(f))
+        except FileNotFoundError:
+            logger.debug(f'No schedule file \'{self.__path}\'')
+        except Exception as ex:
+            logger.warning(f'Could not read/interpret file: \'{self.__path}\'')
+            logger.debug(ex)
+
+
+    def start(self):
+        with self.__lock:
+            self.__run(Scheduler.instance().time())
+
+
+    def stop(self):
+        Scheduler.instance().cancel(self.__key)
+
+
+    def get(self) -> dict:
+        with self.__lock:
+            document = self.__document()
+            i = bisect.bisect_right(self.__times,Scheduler.instance().time())
+            document[NEXT] = self.__times[i] if self.__enabled and i < len(self.__times) else None
+            return document
+
+
+    def put(self, document: dict):
+        with self.__lock:
+            hold = self.__hold
+            self.__parse(document)
+            self.__hold = hold
+            self.__save()
+            self.__last = None
+            self.__run(Scheduler.instance().time())
+
+
+    def hold(self, payload: dict):
+        """Suspend transitions until an absolute 'until' or for 'duration' seconds.
+
+        A zero duration or a null 'until' ends the hold immediately. Optional
+        'settings' are applied for the length of the hold.
+        """
+        if not isinstance(payload,dict):
+            raise TypeError('Hold is not type dict.')
+
+        now = Scheduler.instance().time()
+        until = None
+        if DURATION in payload:
+            if not isinstance(payload[DURATION],(int,float)) or payload[DURATION] < 0:
+                raise ValueError('Hold duration is not a positive number.')
+            until = now + payload[DURATION] if payload[DURATION] > 0 else None
+        elif UNTIL in payload:
+            if not payload[UNTIL] is None and not isinstance(payload[UNTIL],(int,float)):
+                raise TypeError('Hold until is not a number.')
+            until = payload[UNTIL] if not payload[UNTIL] is None and payload[UNTIL] > now else None
+        else:
+            raise KeyError('Hold requires duration or until.')
+
+        settings = payload.get(SETTINGS)
+        if not settings is None:
+            self.__validate(settings)
+
+        with self.__lock:
+            if until is None:
+                logger.info('Schedule hold cleared.')
+                self.__hold = None
+                self.__last = None
+            else:
+                logger.info(f'Schedule held until {time.ctime(until)}.')
+                self.__hold = (until, settings)
+                if not settings is None:
+                    self.__apply(settings)
+            self.__save()
+            self.__run(now)
+
+
+    def __run(self, now: float):
+        """Apply whatever is due at now and sleep until the next transition."""
+        if not self.__hold is None and self.__hold[0] <= now:
+            logger.info('Schedule hold expired.')
+            self.__hold = None
+            self.__last = None
+            self.__save()
+
+        if len(self.__times) == 0 or self.__times[-1] - now < 86400:
+            self.__build_index(now)
+
+        i = bisect.bisect_right(self.__times,now)
+
+        if self.__enabled and self.__hold is None and i > 0:
+            # The most recent transition wins; earlier ones missed while
+            # held or asleep are not replayed.
+            if self.__last is None or self.__times[i - 1] > self.__last:
+                self.__last = self.__times[i - 1]
+                self.__save()
+                logger.info(f'Schedule transition at {time.ctime(self.__last)}.')
+                try:
+                    self.__apply(self.__events[i - 1])
+                except Exception as ex:
+                    logger.warning(ex)
+
+        wake = now + MAX_SLEEP
+        if self.__enabled and i < len(self.__times):
+            wake = min(wake,self.__times[i])
+        if not self.__hold is None:
+            wake = min(wake,self.__hold[0])
+
+        Scheduler.instance().schedule(self.__key,wake - now,self.__on_timer,blocking=True)
+
+
+    def __on_timer(self):
+        with self.__lock:
+            self.__run(Scheduler.instance().time())
+
+
+    def __build_index(self, now: float):
+        times = []
+        events = []
+        today = datetime.date.fromtimestamp(now)
+        for offset in range(-1,INDEX_DAYS):
+            day = today + datetime.timedelta(days=offset)
+            if day.isoformat() in self.__holidays:
+                entries = self.__holidays[day.isoformat()]
+            else:
+                entries = [(minute, settings) for (weekday, minute, settings) in self.__weekly if weekday == day.weekday()]
+            for (minute, settings) in entries:
+                when = datetime.datetime.combine(day,datetime.time(minute // 60,minute % 60)).timestamp()
+                times.append(when)
+                events.append(settings)
+
+        order = sorted(range(len(times)),key=lambda i: times[i])
+        self.__times = [times[i] for i in order]
+        self.__events = [events[i] for i in order]
+
+
+    def __parse(self, document: dict):
+        if not isinstance(document,dict):
+            raise TypeError('Schedule is not type dict.')
+
+        enabled = document.get(ENABLED,True)
+        if not isinstance(enabled,bool):
+            raise TypeError('Schedule enabled is not type bool.')
+
+        weekly = []
+        for entry in document.get(WEEKLY,[]):
+            minute = self.__parse_time(entry)
+            settings = self.__parse_settings(entry)
+            if not isinstance(entry.get(DAYS),list) or len(entry[DAYS]) == 0:
+                raise ValueError('Weekly entry requires a list of days.')
+            for day in entry[DAYS]:
+                if not day in DAY_NAMES:
+                    raise ValueError(f'Day is unknown value \'{day}\'')
+                weekly.append((DAY_NAMES.index(day), minute, settings))
+
+        holidays = {}
+        for holiday in document.get(HOLIDAYS,[]):
+            if not isinstance(holiday,dict) or not isinstance(holiday.get(DATE),str):
+                raise TypeError('Holiday entry requires a date string.')
+            date = datetime.date.fromisoformat(holiday[DATE]).isoformat()
+            holidays[date] = [(self.__parse_time(entry), self.__parse_settings(entry)) for entry in holiday.get(EVENTS,[])]
+
+        hold = None
+        if isinstance(document.get(HOLD),dict) and isinstance(document[HOLD].get(UNTIL),(int,float)):
+            settings = document[HOLD].get(SETTINGS)
+            if not settings is None:
+                self.__validate(settings)
+            hold = (document[HOLD][UNTIL], settings)
+
+        last = document.get(LAST)
+
+        self.__enabled = enabled
+        self.__last = last if isinstance(last,(int,float)) else None
+        self.__weekly = weekly
+        self.__holidays = holidays
+        self.__hold = hold
+        self.__times = []
+        self.__events = []
+
+
+    def __parse_time(self, entry: dict) -> int:
+        if not isinstance(entry,dict) or not isinstance(entry.get(TIME),str):
+            raise TypeError('Schedule entry requires a time string.')
+        (hour, minute) = entry[TIME].split(':')
+        (hour, minute) = (int(hour), int(minute))
+        if hour < 0 or hour > 23 or minute < 0 or minute > 59:
+            raise ValueError(f'Time is out of range \'{entry[TIME]}\'')
+        return hour * 60 + minute
+
+
+    def __parse_settings(self, entry: dict) -> dict:
+        settings = {k: v for (k, v) in entry.items() if k != TIME and k != DAYS}
+        if len(settings) == 0:
+            raise ValueError('Schedule entry has no settings.')
+        self.__validate(settings)
+        return settings
+
+
+    def __document(self) -> dict:
+        weekly = {}
+        for (weekday, minute, settings) in self.__weekly:
+            # Days sharing a time and settings collapse back into one entry.
+            key = (minute, json.dumps(settings,sort_keys=True))
+            weekly.setdefault(key,[]).append(DAY_NAMES[weekday])
+
+        document = {
+            ENABLED: self.__enabled,
+            WEEKLY: [dict(json.loads(settings), **{DAYS: days, TIME: f'{minute // 60:02d}:{minute % 60:02d}'}) for ((minute, settings), days) in weekly.items()],
+            HOLIDAYS: [{DATE: date, EVENTS: [dict(settings, **{TIME: f'{minute // 60:02d}:{minute % 60:02d}'}) for (minute, settings) in events]} for (date, events) in self.__holidays.items()],
+        }
+        if not self.__hold is None:
+            document[HOLD] = {UNTIL: self.__hold[0], SETTINGS: self.__hold[1]}
+        if not self.__last is None:
+            # Remembered so a restart does not undo a manual change made since the last transition.
+            document[LAST] = self.__last
+        return document
+
+
+    def __save(self):
+        try:
+            with open(self.__path,'w') as f:
+                json.dump(self.__document(),f)
+        except Exception as ex:
+            logger.warning(f'Could not write file: \'{self.__path}\'')
+            logger.debug(ex)
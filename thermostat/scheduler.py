@@ -0,0 +1,214 @@
+import asyncio
+import heapq
+import threading
+import time
+
+from project_common.logger import logger
+
+
+# Entry fields: (due, sequence, callback, args, period, blocking)
+_DUE = 0
+_SEQUENCE = 1
+
+
+class Scheduler():
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if Scheduler.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return Scheduler.__instance
+
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, clock=None):
+        """Runs delayed and periodic callbacks.
+
+        Without a loop the callbacks run on a dedicated 'scheduler' thread.
+        With a loop they run as a task on that loop and callbacks marked
+        blocking are handed to the loop's default executor. With a clock, an
+        object with monotonic() and time() such as a simulated one, due times
+        follow that clock and callbacks run only from run_due().
+        """
+        if Scheduler.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        # Heap of (due, sequence, key). Entries that have been replaced or
+        # cancelled are left in the heap and skipped when they come due.
+        self.__queue = []
+        # key -> entry
+        self.__entries = {}
+        self.__sequence = 0
+        self.__running = True
+
+        self.__cond = threading.Condition()
+        self.__loop = loop
+        self.__clock = time if clock is None else clock
+
+        if not clock is None:
+            # Driven by run_due() alone.
+            self.__thread = None
+        elif loop is None:
+            self.__thread = threading.Thread(target=self.__thread_run,name='scheduler')
+            self.__thread.start()
+        else:
+            self.__wake = asyncio.Event()
+            self.__task = loop.create_task(self.__task_run())
+
+        Scheduler.__instance = self
+
+
+    def stop(self, timeout: float = None):
+        with self.__cond:
+            self.__running = False
+            self.__entries.clear()
+            self.__notify()
+        if self.__loop is None and not self.__thread is None:
+            # A callback that is already running is allowed to finish, but not past the timeout.
+            self.__thread.join(timeout)
+            if self.__thread.is_alive():
+                logger.warning('Scheduler did not stop in time.')
+
+
+    async def join(self):
+        await self.__task
+
+
+    def time(self) -> float:
+        """Wall clock time on the scheduler's clock."""
+        return self.__clock.time()
+
+
+    def run_due(self):
+        """Run every callback that is due on the clock, on the calling thread."""
+        while True:
+            with self.__cond:
+                if not self.__running:
+                    return
+                entry = self.__pop_due(self.__clock.monotonic())
+            if entry is None:
+                return
+
+            (_, _, callback, args, _, _) = entry
+            try:
+                callback(*args)
+            except Exception as ex:
+                logger.critical(ex)
+
+
+    def schedule(self, key: str, delay: float, callback, *args, blocking: bool = False):
+        """Run callback(*args) after delay seconds.
+
+        Scheduling a key that is already pending replaces it, so repeated
+        requests within the delay coalesce into a single call.
+        """
+        self.__add(key,self.__clock.monotonic() + max(delay,0.0),callback,args,None,blocking)
+
+
+    def every(self, key: str, period: float, callback, *args, blocking: bool = False):
+        """Run callback(*args) every period seconds, starting now.
+
+        The period is kept against the original due times; periods missed
+        because a callback overran are skipped rather than run back to back.
+        """
+        self.__add(key,self.__clock.monotonic(),callback,args,period,blocking)
+
+
+    def cancel(self, key: str) -> bool:
+        with self.__cond:
+            return self.__entries.pop(key,None) is not None
+
+
+    def pending(self, key: str) -> bool:
+        with self.__cond:
+            return key in self.__entries
+
+
+    def __add(self, key: str, due: float, callback, args: tuple, period: float, blocking: bool):
+        with self.__cond:
+            self.__sequence += 1
+            self.__entries[key] = (due, self.__sequence, callback, args, period, blocking)
+            heapq.heappush(self.__queue,(due, self.__sequence, key))
+            self.__notify()
+
+
+    def __notify(self):
+        if self.__loop is None:
+            self.__cond.notify()
+        else:
+            self.__loop.call_soon_threadsafe(self.__wake.set)
+
+
+    def __pop_due(self, now: float):
+        while len(self.__queue) != 0 and self.__queue[0][_DUE] <= now:
+            (_, sequence, key) = heapq.heappop(self.__queue)
+            entry = self.__entries.get(key)
+            if entry is None or entry[_SEQUENCE] != sequence:
+                continue
+
+            (due, _, callback, args, period, blocking) = entry
+            if period is None:
+                del self.__entries[key]
+            else:
+                # Rearm before running so a cancel from within the callback sticks.
+                while due <= now:
+                    due += period
+                self.__sequence += 1
+                self.__entries[key] = (due, self.__sequence, callback, args, period, blocking)
+                heapq.heappush(self.__queue,(due, self.__sequence, key))
+            return entry
+        return None
+
+
+    def __timeout(self, now: float) -> float:
+        return self.__queue[0][_DUE] - now if len(self.__queue) != 0 else None
+
+
+    def __thread_run(self):
+        while True:
+            with self.__cond:
+                entry = None
+                while self.__running:
+                    now = self.__clock.monotonic()
+                    entry = self.__pop_due(now)
+                    if not entry is None:
+                        break
+                    self.__cond.wait(self.__timeout(now))
+
+                if not self.__running:
+                    return
+
+            (_, _, callback, args, _, _) = entry
+            try:
+                callback(*args)
+            except Exception as ex:
+                logger.critical(ex)
+
+
+    async def __task_run(self):
+        while True:
+            with self.__cond:
+                if not self.__running:
+                    return
+                now = self.__clock.monotonic()
+                entry = self.__pop_due(now)
+                timeout = self.__timeout(now)
+                self.__wake.clear()
+
+            if entry is None:
+                try:
+                    await asyncio.wait_for(self.__wake.wait(),timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            (_, _, callback, args, _, blocking) = entry
+            try:
+                if blocking:
+                    await self.__loop.run_in_executor(None,callback,*args)
+                else:
+                    callback(*args)
+            except Exception as ex:
+                logger.critical(ex)
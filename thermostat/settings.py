@@ -1,12 +1,18 @@
+import collections
 import os
 import json
-from threading import Timer
+import time
+import threading
 
 from project_common.logger import logger
 from project_common.mqtt import Mqtt, mqtt
 from .config import Config
 from . import control
+from . import metrics
 from .control import Control
+from .publisher import Publisher, PRIORITY_HIGH
+from .scheduler import Scheduler
+from .schedule import Schedule
 
 
 MODE = 'mode'
@@ -17,6 +23,9 @@ class Settings():
 
     CMD = 'cmd'
     RESULT = 'result'
+    IMMEDIATE = 'immediate'
+    ID = 'id'
+    REPLY_TO = 'reply-to'
 
     RESULT_OK = 'OK'
     RESULT_FAIL = 'FAIL'
@@ -27,43 +36,136 @@ class Settings():
     CMD_GET_FAN = 'get-fan'
     CMD_PUT_FAN = 'put-fan'
 
+    CMD_GET_SCHEDULE = 'get-schedule'
+    CMD_PUT_SCHEDULE = 'put-schedule'
+    CMD_PUT_HOLD = 'put-hold'
+
+    MODES = frozenset([control.MODE_OFF, control.MODE_AUTO, control.MODE_COOL, control.MODE_HEAT])
+    FANS = frozenset([control.MODE_AUTO, control.MODE_ON])
+
     DEFAULT_SETTINGS = {MODE: control.MODE_OFF, control.MODE_HEAT: 22.22, control.MODE_COOL: 23.889}
 
-    __instance = None
+    # Commands that only read, and are safe to answer for local consumers.
+    QUERIES = frozenset([CMD_GET_SETTINGS, CMD_GET_FAN, CMD_GET_SCHEDULE])
+
+    PUSH_KEY = 'settings-push'
+    SAVE_KEY = 'settings-save'
+    ACTION_KEY = 'settings-action'
+
+    # Admitted action messages waiting to run, and clients whose rate is tracked.
+    ACTION_QUEUE = 16
+    ACTION_CLIENTS = 64
+    # Clients' worth of rate and burst that all clients share between them.
+    ACTION_SHARED = 4
+
+    # One instance per zone, keyed by zone name (None without zones).
+    __instances = {}
 
 
     @staticmethod
-    def instance():
-        if Settings.__instance is None:
+    def instance(zone: str = None):
+        if not zone in Settings.__instances:
             raise Exception('Instance has not been created.')
 
-        return Settings.__instance
+        return Settings.__instances[zone]
 
 
-    def __init__(self):
-        if Settings.__instance is not None:
-            raise Exception('Singleton instance already created.')
+    @staticmethod
+    def instances() -> list:
+        return list(Settings.__instances.values())
+
 
-        self.__topic = Config.instance().topic()
+    def __init__(self, config: Config = None):
+        self.__config = Config.instance() if config is None else config
+
+        if self.__config.zone() in Settings.__instances:
+            raise Exception('Singleton instance already created.')
 
-        self.__settings = Settings.DEFAULT_SETTINGS
+        self.__topic = self.__config.topic()
+        self.__control = Control.instance(self.__config.zone())
+
+        # Scheduler keys are per zone so zones do not coalesce into each other.
+        suffix = '' if self.__config.zone() is None else f'/{self.__config.zone()}'
+        self.__push_key = f'{Settings.PUSH_KEY}{suffix}'
+        self.__save_key = f'{Settings.SAVE_KEY}{suffix}'
+        self.__action_key = f'{Settings.ACTION_KEY}{suffix}'
+
+        # (payload, reply topic, reply properties, superseded) admitted on the
+        # network thread and run from the scheduler. superseded lists the
+        # (command, reply topic, reply properties) of put-settings it replaced,
+        # which are answered with its result.
+        self.__actions_lock = threading.Lock()
+        self.__actions = collections.deque()
+        self.__actions_full = False
+        # reply topic -> [tokens, time last refilled, throttled], least recently heard from first,
+        # and the bucket behind them all. Only touched on the network thread.
+        self.__buckets = {}
+        self.__shared = [self.__config.action_burst() * Settings.ACTION_SHARED, time.monotonic(), False]
+
+        self.__settings = dict(Settings.DEFAULT_SETTINGS)
         self.__fan = control.MODE_AUTO
+        # Settings last handed to control; put-fan applies at once without
+        # taking debounced setpoint changes along with it.
+        self.__pushed = dict(self.__settings)
+        # Serialises building and swapping the setpoints; control never takes it.
+        self.__push_lock = threading.Lock()
 
         try:
-            with open(Config.instance().settings_file(),'r') as f:
+            with open(self.__config.settings_file(),'r') as f:
                 s = json.load(f)
-                self.__validate_mode(s)
-                self.__validate_setpoint(s)
+                self.__validate_mode(s,self.__settings)
+                self.__validate_setpoint(s,self.__settings)
         except Exception as ex:
-            logger.warning(f'Could not read/interpret file: \'{Config.instance().settings_file()}\'')
+            logger.warning(f'Could not read/interpret file: \'{self.__config.settings_file()}\'')
             logger.debug(ex)
 
-        self.__push_timer = None
+        # cmd -> (handler, result key required)
+        self.__commands = {
+            Settings.CMD_GET_SETTINGS: (self.__get_settings, False),
+            Settings.CMD_PUT_SETTINGS: (self.__put_settings, True),
+            Settings.CMD_GET_FAN: (self.__get_fan, False),
+            Settings.CMD_PUT_FAN: (self.__put_fan, True),
+            Settings.CMD_GET_SCHEDULE: (self.__get_schedule, False),
+            Settings.CMD_PUT_SCHEDULE: (self.__put_schedule, True),
+            Settings.CMD_PUT_HOLD: (self.__put_hold, True),
+        }
+
+        self.__debounce = self.__config.settings_debounce()
         self.__push_settings()
 
+        self.__config.register_on_reload(self.__on_reload)
+
+        self.__schedule = Schedule(self.__config.schedule_file(),self.__apply_scheduled,self.__check_settings,f'schedule{suffix}')
+        self.__schedule.start()
+
         Mqtt.instance().register_on_connect(self.__on_connect)
 
-        Settings.__instance = self
+        Settings.__instances[self.__config.zone()] = self
+
+
+    def stop(self):
+        self.__schedule.stop()
+        if Scheduler.instance().cancel(self.__action_key):
+            # Answer what was admitted before the replies can no longer go out.
+            self.__run_actions()
+        Scheduler.instance().cancel(self.__push_key)
+        if Scheduler.instance().cancel(self.__save_key):
+            # Do not lose a save that was still waiting on the scheduler.
+            self.__write()
+
+
+    def query(self,command: dict) -> dict:
+        """Answer a read-only command from memory; None if it is not one."""
+        if not isinstance(command,dict) or not isinstance(command.get(Settings.CMD),str) or not command[Settings.CMD] in Settings.QUERIES:
+            return None
+        return self.__dispatch(command)
+
+
+    def __on_reload(self):
+        self.__debounce = self.__config.settings_debounce()
+        # The thresholds carry the hysteresis.
+        with self.__push_lock:
+            self.__set_setpoints(self.__pushed)
 
 
     def __on_connect(self,client, userdata, flags, rc):
@@ -79,116 +181,352 @@ class Settings():
 
 
     def __on_mqtt_message(self,client,userdata,message):
+        # Runs on the network thread, so only admission happens here: the size
+        # is checked before parsing, each client is rate limited, and the
+        # commands themselves run from the scheduler.
+        if os.path.basename(message.topic) != Settings.ACTION:
+            return
+
+        try:
+            size = len(message.payload)
+        except:
+            logger.debug('I give up... recieved a really broken mqtt message.')
+            return
+
+        if size > self.__config.action_max_size():
+            metrics.inc(metrics.ACTION_DROPPED)
+            logger.debug(f'{message.topic} payload of {size} bytes is over the {self.__config.action_max_size()} byte limit.')
+            return
+
         try:
             logger.debug(f'{message.topic} -> {message.payload}')
         except:
-            try:
-                logger.debug(f'{message.topic} has an unknown payload of type {type(message.payload)}')
-            except:
-                logger.debug('I give up... recieved a really broken mqtt message.')
-                return
+            logger.debug(f'{message.topic} has an unknown payload of type {type(message.payload)}')
 
-        if os.path.basename(message.topic) == Settings.ACTION:
-            payload = {}
-            try:
-                payload = json.loads(message.payload)
-            except:
-                logger.warning(f'Received message payload is not valid json: "{message.payload}"')
+        valid = True
+        try:
+            payload = json.loads(message.payload)
+        except:
+            (payload, valid) = (None, False)
+
+        (topic, properties) = self.__reply_route(message,payload)
+
+        if not self.__admit(topic,max(1,len(payload)) if isinstance(payload,list) else 1):
+            metrics.inc(metrics.ACTION_THROTTLED)
+            return
+
+        if not valid:
+            logger.warning(f'Received message payload is not valid json: "{message.payload}"')
+            return
+
+        self.__queue(payload,topic,properties)
+
+
+    def __admit(self,client: str,cost: int) -> bool:
+        # Clients are told apart by reply topic, so all of them also draw from the shared bucket.
+        rate = self.__config.action_rate()
+        if rate == 0:
+            return True
+        burst = self.__config.action_burst()
+        now = time.monotonic()
+
+        bucket = self.__buckets.pop(client,None)
+        if bucket is None:
+            bucket = [burst, now, False]
+            if len(self.__buckets) >= Settings.ACTION_CLIENTS:
+                # Forget the client heard from least recently.
+                del self.__buckets[next(iter(self.__buckets))]
+        # Re-inserted to keep the clients in the order they were last heard from.
+        self.__buckets[client] = bucket
+
+        self.__refill(bucket,rate,burst,now)
+        self.__refill(self.__shared,rate * Settings.ACTION_SHARED,burst * Settings.ACTION_SHARED,now)
+        # A batch bigger than the burst needs a full bucket rather than never getting in.
+        cost = min(cost,burst)
+        if bucket[0] < cost:
+            if not bucket[2]:
+                logger.warning(f'Throttling action messages replying to \'{client}\'.')
+                bucket[2] = True
+            return False
+        if self.__shared[0] < cost:
+            if not self.__shared[2]:
+                logger.warning('Throttling action messages from all clients.')
+                self.__shared[2] = True
+            return False
+
+        bucket[0] -= cost
+        bucket[2] = False
+        self.__shared[0] -= cost
+        self.__shared[2] = False
+        return True
+
+
+    def __refill(self,bucket: list,rate: float,burst: float,now: float):
+        bucket[0] = min(burst,bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+
+    def __queue(self,payload,topic: str,properties):
+        superseded = []
+        with self.__actions_lock:
+            if self.__replaces_settings(payload):
+                kept = collections.deque()
+                for action in self.__actions:
+                    (command, reply_topic, reply_properties, replaced) = action
+                    if self.__is_put_settings(command) and self.__supersedes(payload[Settings.RESULT],command[Settings.RESULT]):
+                        metrics.inc(metrics.ACTION_SUPERSEDED)
+                        superseded.append((command, reply_topic, reply_properties))
+                        superseded.extend(replaced)
+                        # The push it asked for is not lost with it.
+                        if command.get(Settings.IMMEDIATE) is True:
+                            payload[Settings.IMMEDIATE] = True
+                    else:
+                        kept.append(action)
+                self.__actions = kept
+
+            if len(self.__actions) >= Settings.ACTION_QUEUE:
+                metrics.inc(metrics.ACTION_DROPPED)
+                if not self.__actions_full:
+                    logger.warning('Action queue is full, dropping messages.')
+                    self.__actions_full = True
                 return
+            self.__actions_full = False
+            self.__actions.append((payload, topic, properties, superseded))
 
-            if not Settings.CMD in payload:
-                logger.warning('Action message missing command key.')
-                return
+        Scheduler.instance().schedule(self.__action_key,0,self.__run_actions,blocking=True)
+
+
+    def __is_put_settings(self,payload) -> bool:
+        return isinstance(payload,dict) and payload.get(Settings.CMD) == Settings.CMD_PUT_SETTINGS and isinstance(payload.get(Settings.RESULT),dict)
+
+
+    def __replaces_settings(self,payload) -> bool:
+        # A put-settings that will succeed may replace queued ones.
+        if not self.__is_put_settings(payload):
+            return False
+        try:
+            self.__check_settings(payload[Settings.RESULT])
+        except Exception:
+            return False
+        return True
+
+
+    def __supersedes(self,new: dict,old: dict) -> bool:
+        # Whether applying new alone ends where applying old and then new would.
+        if MODE in old and not MODE in new:
+            return False
+        # Either setpoint can move the other through the auto delta, so only both replace either.
+        if (control.MODE_HEAT in old or control.MODE_COOL in old) and not (control.MODE_HEAT in new and control.MODE_COOL in new):
+            return False
+        return True
+
+
+    def __run_actions(self):
+        while True:
+            with self.__actions_lock:
+                if len(self.__actions) == 0:
+                    return
+                (payload, topic, properties, superseded) = self.__actions.popleft()
+            response = self.__handle(payload,topic,properties)
+
+            for (command, reply_topic, reply_properties) in superseded:
+                # Answered as the request that replaced it was, under its own id.
+                reply = {key: value for (key, value) in response.items() if key != Settings.ID}
+                if Settings.ID in command:
+                    reply[Settings.ID] = command[Settings.ID]
+                self.__publish(reply,reply_topic,reply_properties)
+
+
+    def __handle(self,payload,topic: str,properties):
+        # Returns the reply as published.
+        if isinstance(payload,list):
+            # A batch of commands is answered with a single list of results.
+            responses = []
+            for command in payload:
+                response = self.__dispatch(command)
+                if not response is None:
+                    responses.append(response)
+            if len(responses) != 0:
+                self.__publish(responses,topic,properties)
+            return responses
+
+        response = self.__dispatch(payload)
+        if not response is None:
+            self.__publish(response,topic,properties)
+        return response
+
+
+    def __reply_route(self,message,payload) -> tuple:
+        # MQTT v5 response topic first, then the first command's reply-to, then the shared topic.
+        topic = self.__topic
+        properties = None
+
+        request = getattr(message,'properties',None)
+        response_topic = getattr(request,'ResponseTopic',None)
+        correlation = getattr(request,'CorrelationData',None)
+
+        if not correlation is None:
+            properties = mqtt.client.Properties(mqtt.client.PacketTypes.PUBLISH)
+            properties.CorrelationData = correlation
+
+        if isinstance(response_topic,str) and response_topic != '':
+            topic = response_topic
+        else:
+            first = payload[0] if isinstance(payload,list) and len(payload) != 0 else payload
+            if isinstance(first,dict) and isinstance(first.get(Settings.REPLY_TO),str) and first[Settings.REPLY_TO] != '':
+                topic = first[Settings.REPLY_TO]
+
+        return (topic, properties)
+
+
+    def __dispatch(self,command: dict) -> dict:
+        if not isinstance(command,dict) or not Settings.CMD in command:
+            logger.warning('Action message missing command key.')
+            return None
+
+        cmd = command[Settings.CMD]
+        handler = self.__commands.get(cmd) if isinstance(cmd,str) else None
+        if handler is None:
+            logger.warning(f'Command is unknown: \'{cmd}\'')
+            return None
 
-            if payload[Settings.CMD] == Settings.CMD_GET_SETTINGS:
-                self.__get_settings()
-            elif payload[Settings.CMD] == Settings.CMD_PUT_SETTINGS:
-                if not Settings.RESULT in payload:
-                    logger.warning('Result key missing in \'{payload[Settings.CMD]}\'')
-                    self.__publish({Settings.CMD: payload[Settings.CMD], Settings.RESULT: Settings.RESULT_FAIL})
-                else:
-                    self.__put_settings(payload[Settings.RESULT])
-            elif payload[Settings.CMD] == Settings.CMD_GET_FAN:
-                self.__get_fan()
-            elif payload[Settings.CMD] == Settings.CMD_PUT_FAN:
-                if not Settings.RESULT in payload:
-                    logger.warning('Result key missing in \'{payload[Settings.CMD]}\'')
-                    self.__publish({Settings.CMD: payload[Settings.CMD], Settings.RESULT: Settings.RESULT_FAIL})
-                else:
-                    self.__put_fan(payload[Settings.RESULT])
-            else:
-                logger.warning('Command is unknown: \'{payload[Settings.CMD]}\'')
-
-
-    def __get_settings(self):
-        payload = {Settings.CMD: Settings.CMD_GET_SETTINGS, Settings.RESULT: self.__settings}
-        self.__publish(payload)
-
-
-    def __put_settings(self,payload: dict):
+        (callback, needs_result) = handler
+        if needs_result and not Settings.RESULT in command:
+            logger.warning(f'Result key missing in \'{cmd}\'')
+            response = {Settings.CMD: cmd, Settings.RESULT: Settings.RESULT_FAIL}
+        else:
+            response = callback(command)
+
+        # Echo the client's correlation id so pipelined requests can be matched.
+        if Settings.ID in command:
+            response[Settings.ID] = command[Settings.ID]
+        return response
+
+
+    def __get_settings(self,command: dict) -> dict:
+        return {Settings.CMD: Settings.CMD_GET_SETTINGS, Settings.RESULT: self.__settings}
+
+
+    def __put_settings(self,command: dict) -> dict:
+        payload = command[Settings.RESULT]
+        settings = dict(self.__settings)
         try:
-            self.__validate_mode(payload)
-            self.__validate_setpoint(payload)
+            self.__validate_mode(payload,settings)
+            self.__validate_setpoint(payload,settings)
         except Exception as ex:
             logger.warning(ex)
             logger.debug(f'Settings message is incorrect: \'{json.dumps(payload)}\'')
-            self.__publish({Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: Settings.RESULT_FAIL})
-        else:
-            self.__set_push()
-            self.__publish({Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: Settings.RESULT_OK})
-            # Save the settings file.
-            try:
-                with open(Config.instance().settings_file(),'w') as f:
-                   json.dump(self.__settings,f)
-            except Exception as ex:
-                logger.warning(f'Could not write file: \'{Config.instance().settings_file()}\'')
-                logger.debug(ex)
+            return {Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: Settings.RESULT_FAIL}
+
+        self.__settings = settings
+        self.__set_push(command.get(Settings.IMMEDIATE) is True)
+        self.__save()
+        return {Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: Settings.RESULT_OK}
 
 
-    def __get_fan(self):
-        payload = {Settings.CMD: Settings.CMD_GET_FAN, Settings.RESULT: self.__fan}
-        self.__publish(payload)
+    def __get_fan(self,command: dict) -> dict:
+        return {Settings.CMD: Settings.CMD_GET_FAN, Settings.RESULT: self.__fan}
 
 
-    def __put_fan(self,payload: dict):
+    def __put_fan(self,command: dict) -> dict:
+        payload = command[Settings.RESULT]
         try:
             self.__validate_fan(payload)
         except Exception as ex:
             logger.warning(ex)
             logger.debug(f'Fan message is incorrect: \'{json.dumps(payload)}\'')
-            self.__publish({Settings.CMD: Settings.CMD_PUT_FAN, Settings.RESULT: Settings.RESULT_FAIL})
-        else:
+            return {Settings.CMD: Settings.CMD_PUT_FAN, Settings.RESULT: Settings.RESULT_FAIL}
+
+        with self.__push_lock:
             self.__fan = payload[control.FAN]
-            Control.instance().set_blower(self.__fan)
-            self.__publish({Settings.CMD: Settings.CMD_PUT_FAN, Settings.RESULT: Settings.RESULT_OK})
+            self.__set_setpoints(self.__pushed)
+        return {Settings.CMD: Settings.CMD_PUT_FAN, Settings.RESULT: Settings.RESULT_OK}
 
 
+    def __get_schedule(self,command: dict) -> dict:
+        return {Settings.CMD: Settings.CMD_GET_SCHEDULE, Settings.RESULT: self.__schedule.get()}
 
-    def __validate_mode(self,payload: dict):
+
+    def __put_schedule(self,command: dict) -> dict:
+        try:
+            self.__schedule.put(command[Settings.RESULT])
+        except Exception as ex:
+            logger.warning(ex)
+            logger.debug(f'Schedule message is incorrect: \'{json.dumps(command[Settings.RESULT])}\'')
+            return {Settings.CMD: Settings.CMD_PUT_SCHEDULE, Settings.RESULT: Settings.RESULT_FAIL}
+        return {Settings.CMD: Settings.CMD_PUT_SCHEDULE, Settings.RESULT: Settings.RESULT_OK}
+
+
+    def __put_hold(self,command: dict) -> dict:
+        try:
+            self.__schedule.hold(command[Settings.RESULT])
+        except Exception as ex:
+            logger.warning(ex)
+            logger.debug(f'Hold message is incorrect: \'{json.dumps(command[Settings.RESULT])}\'')
+            return {Settings.CMD: Settings.CMD_PUT_HOLD, Settings.RESULT: Settings.RESULT_FAIL}
+        return {Settings.CMD: Settings.CMD_PUT_HOLD, Settings.RESULT: Settings.RESULT_OK}
+
+
+    def __apply_scheduled(self,payload: dict):
+        settings = dict(self.__settings)
+        self.__validate_mode(payload,settings)
+        self.__validate_setpoint(payload,settings)
+        self.__settings = settings
+        self.__set_push(True)
+        self.__save()
+        # Let clients know the settings changed underneath them.
+        self.__publish(self.__get_settings(None))
+
+
+    def __check_settings(self,payload: dict):
+        if not isinstance(payload,dict):
+            raise TypeError('Settings is not type dict.')
+        settings = dict(self.__settings)
+        self.__validate_mode(payload,settings)
+        self.__validate_setpoint(payload,settings)
+
+
+    def __save(self):
+        # Written from the scheduler so bursts coalesce and the caller never blocks on the file system.
+        Scheduler.instance().schedule(self.__save_key,0,self.__write,blocking=True)
+
+
+    def __write(self):
+        time_in = time.monotonic()
+        try:
+            with open(self.__config.settings_file(),'w') as f:
+               json.dump(self.__settings,f)
+            duration = time.monotonic() - time_in
+            metrics.inc(metrics.SETTINGS_WRITES)
+            metrics.inc(metrics.SETTINGS_WRITE_SECONDS,duration)
+            metrics.gauge(metrics.SETTINGS_WRITE_LAST_SECONDS,duration)
+        except Exception as ex:
+            logger.warning(f'Could not write file: \'{self.__config.settings_file()}\'')
+            logger.debug(ex)
+
+
+    def __validate_mode(self,payload: dict,settings: dict):
         if MODE in payload:
             if not isinstance(payload[MODE],str):
                 raise TypeError('Mode is not type string.')
             mode = payload[MODE]
-            if mode != control.MODE_OFF \
-                and mode != control.MODE_AUTO \
-                and mode != control.MODE_COOL \
-                and mode != control.MODE_HEAT:
+            if not mode in Settings.MODES:
                 raise ValueError(f'Mode is unknown value \'{mode}\'')
-            self.__settings[MODE] = mode
+            settings[MODE] = mode
 
 
-    def __validate_setpoint(self,payload: dict):
+    def __validate_setpoint(self,payload: dict,settings: dict):
         if control.MODE_HEAT in payload:
             if not isinstance(payload[control.MODE_HEAT],float):
                 # Some json encoders (Qt) will turn doubles/floats into integers
                 # if there is no decimal place (ie 25.0 becomes 25 in the json output)
                 if not isinstance(payload[control.MODE_HEAT],int):
                     raise TypeError('Setpoint heat is not type float or integer.')
-            self.__settings[control.MODE_HEAT] = payload[control.MODE_HEAT]
+            settings[control.MODE_HEAT] = payload[control.MODE_HEAT]
 
             # Correct cool setpoint for imposed delta.
-            if self.__settings[control.MODE_HEAT] + Config.instance().auto_temp_delta() > self.__settings[control.MODE_COOL]:
-                self.__settings[control.MODE_COOL] = self.__settings[control.MODE_HEAT] + Config.instance().auto_temp_delta()
+            if settings[control.MODE_HEAT] + self.__config.auto_temp_delta() > settings[control.MODE_COOL]:
+                settings[control.MODE_COOL] = settings[control.MODE_HEAT] + self.__config.auto_temp_delta()
 
         if control.MODE_COOL in payload:
             if not isinstance(payload[control.MODE_COOL],float):
@@ -196,11 +534,11 @@ class Settings():
                 # if there is no decimal place (ie 25.0 becomes 25 in the json output)
                 if not isinstance(payload[control.MODE_COOL],int):
                     raise TypeError('Setpoint cool is not type float or integer.')
-            self.__settings[control.MODE_COOL] = payload[control.MODE_COOL]
+            settings[control.MODE_COOL] = payload[control.MODE_COOL]
 
             # Correct heat setpoint for imposed delta.
-            if self.__settings[control.MODE_HEAT] + Config.instance().auto_temp_delta() > self.__settings[control.MODE_COOL]:
-                self.__settings[control.MODE_HEAT] = self.__settings[control.MODE_COOL] - Config.instance().auto_temp_delta()
+            if settings[control.MODE_HEAT] + self.__config.auto_temp_delta() > settings[control.MODE_COOL]:
+                settings[control.MODE_HEAT] = settings[control.MODE_COOL] - self.__config.auto_temp_delta()
 
 
     def __validate_fan(self,payload: dict):
@@ -209,14 +547,14 @@ class Settings():
         if not isinstance(payload[control.FAN],str):
             raise TypeError('Fan is not type str.')
         fan = payload[control.FAN]
-        if fan != control.MODE_AUTO and fan != control.MODE_ON:
+        if not fan in Settings.FANS:
             raise ValueError(f'Fan is unknown value \'{fan}\'')
 
 
-    def __publish(self,dictionary: dict):
+    def __publish(self,dictionary: dict,topic: str=None,properties=None):
         try:
             p=json.dumps(dictionary)
-            Mqtt.instance().publish(self.__topic,payload=p,qos=2)
+            Publisher.instance().publish(self.__topic if topic is None else topic,p,priority=PRIORITY_HIGH,properties=properties)
             logger.debug(p)
         except Exception as ex:
             logger.warning(ex)
@@ -224,15 +562,20 @@ class Settings():
 
     def __push_settings(self):
         logger.debug('Pushing settings.')
-        Control.instance().set_mode(self.__settings[MODE])
-        Control.instance().set_cool(self.__settings[control.MODE_COOL])
-        Control.instance().set_heat(self.__settings[control.MODE_HEAT])
-
-
-    def __set_push(self):
-        if not self.__push_timer is None:
-            logger.debug('Cancelling push timer.')
-            self.__push_timer.cancel()
-        logger.debug('Setting push timer.')
-        self.__push_timer = Timer(5.0,self.__push_settings)
-        self.__push_timer.start()
\ No newline at end of file
+        with self.__push_lock:
+            self.__pushed = dict(self.__settings)
+            self.__set_setpoints(self.__pushed)
+
+
+    def __set_setpoints(self,settings: dict):
+        self.__control.set_setpoints(control.Setpoints(settings[MODE],settings[control.MODE_HEAT],settings[control.MODE_COOL],self.__fan,self.__config.temp_hysteresis()))
+
+
+    def __set_push(self,immediate: bool):
+        if immediate or self.__debounce == 0:
+            Scheduler.instance().cancel(self.__push_key)
+            self.__push_settings()
+        else:
+            # Rescheduling the same key coalesces a burst of changes into one push.
+            logger.debug(f'Pushing settings in {self.__debounce}s.')
+            Scheduler.instance().schedule(self.__push_key,self.__debounce,self.__push_settings)
@@ -3,10 +3,13 @@ import fcntl
 import threading
 import collections
 import select
-from time import sleep
+import struct
+import time
 
 from project_common.logger import logger
 
+from . import metrics
+
 # IOCTL base value
 SHT3X_IOCTL_BASE = 0x40047800
 
@@ -41,6 +44,15 @@ SHT3X_PERIODIC_10_LOW    = 15
 SHT3X_PERIODIC_10_MED    = 16
 SHT3X_PERIODIC_10_HIGH   = 17
 
+# Measurements per second in each periodic mode
+SHT3X_PERIODIC_RATE = {
+    SHT3X_PERIODIC_0P5_LOW: 0.5, SHT3X_PERIODIC_0P5_MED: 0.5, SHT3X_PERIODIC_0P5_HIGH: 0.5,
+    SHT3X_PERIODIC_1_LOW: 1, SHT3X_PERIODIC_1_MED: 1, SHT3X_PERIODIC_1_HIGH: 1,
+    SHT3X_PERIODIC_2_LOW: 2, SHT3X_PERIODIC_2_MED: 2, SHT3X_PERIODIC_2_HIGH: 2,
+    SHT3X_PERIODIC_4_LOW: 4, SHT3X_PERIODIC_4_MED: 4, SHT3X_PERIODIC_4_HIGH: 4,
+    SHT3X_PERIODIC_10_LOW: 10, SHT3X_PERIODIC_10_MED: 10, SHT3X_PERIODIC_10_HIGH: 10,
+}
+
 # SHT3X status command argument
 SHT3X_STATUS_READ  = 0
 SHT3X_STATUS_CLEAR = 1
@@ -48,92 +60,268 @@ SHT3X_STATUS_CLEAR = 1
 UNITS_CELCIUS = 0
 UNITS_FARENHEIT = 1
 
+# Full scale of the temperature and humidity words.
+COUNTS_MAX = 65535
+
+
+SAMPLE_SIZE = 6
+READ_TIMEOUT = 3
+
+# Raw stream batch: a header followed by count samples, little endian.
+RAW_HEADER = struct.Struct('<IdH')  # sequence, time of the first sample, count
+RAW_SAMPLE = struct.Struct('<IHH')  # microseconds after the first sample, temperature counts, humidity counts
+
+
+def celsius_to_counts(celsius: float) -> int:
+    """The temperature count nearest to celsius."""
+    return round((celsius + 45.0) * COUNTS_MAX / 175)
+
+
+def counts_to_celsius(counts: float) -> float:
+    return -45.0 + (175 * (counts / COUNTS_MAX))
+
 
 class Sht3x():
+    __slots__ = ('__device', '__mode', '__samples', '__sample_array', '__tempsum', '__tempcounts', '__humidity',
+                 '__raw', '__raw_lock', '__raw_capacity', '__raw_count', '__raw_time', '__raw_start', '__raw_sequence',
+                 '__event', '__thread', '__wake')
+
+
     def __init__(self,device: str, mode: int, samples: int):
         self.__device = device
         self.__mode = mode
         self.__samples = samples
+        # (timestamp, temperature counts), oldest first, and the sum of their counts.
+        self.__sample_array = collections.deque()
+        self.__tempsum = 0
+        # (sum, samples) of the window, replaced as a whole so readers see a matching pair.
         self.__tempcounts = None
-        self.__humidity = 0.0
+        self.__humidity = 0
+
+        # Raw stream batch, allocated by enable_raw().
+        self.__raw = None
+        self.__raw_lock = threading.Lock()
+        self.__raw_capacity = 0
+        self.__raw_count = 0
+        self.__raw_time = 0.0
+        self.__raw_start = 0.0
+        self.__raw_sequence = 0
 
         self.__event = threading.Event()
-        self.__thread = threading.Thread(target=self.__run,name='sht3x')
-        self.__thread.start()
+        self.__thread = None
+        self.__wake = None
 
 
     def __del__(self):
         self.stop()
 
 
-    def stop(self):
+    def start(self):
+        """Read the sensor on a dedicated thread."""
+        if self.__thread is None:
+            # Written to by stop() so the reader wakes without waiting out its select timeout.
+            self.__wake = os.pipe()
+            self.__thread = threading.Thread(target=self.__run,name='sht3x')
+            self.__thread.start()
+
+
+    def stop(self, timeout: float = None):
         self.__event.set()
-        self.__thread.join()
+        if not self.__thread is None:
+            os.write(self.__wake[1],b'\0')
+            self.__thread.join(timeout)
+            if self.__thread.is_alive():
+                logger.warning('Sensor thread did not stop in time.')
+                return
+            os.close(self.__wake[0])
+            os.close(self.__wake[1])
+            self.__thread = None
+
+
+    def set_samples(self, samples: int):
+        """Change the averaging window, keeping the samples already collected."""
+        if samples != self.__samples:
+            logger.info(f'Changing temp sample size from {self.__samples} to {samples}')
+            self.__samples = samples
 
 
     def humidity(self) -> float:
-        return self.__humidity
+        return 100 * (self.__humidity / COUNTS_MAX)
+
+
+    def counts(self) -> tuple:
+        """The averaging window as (sum of temperature counts, samples), or None without samples."""
+        # Compare in integers against celsius_to_counts() as sum <= threshold * samples.
+        return self.__tempcounts
+
+
+    def rate(self) -> float:
+        """Measurements per second in the configured mode."""
+        return SHT3X_PERIODIC_RATE.get(self.__mode,1)
+
+
+    def enable_raw(self, capacity: int):
+        """Collect every sample into batches of up to capacity for take_raw()."""
+        # The header counts samples in 16 bits.
+        capacity = min(capacity,0xffff)
+        with self.__raw_lock:
+            self.__raw = bytearray(RAW_HEADER.size + capacity * RAW_SAMPLE.size)
+            self.__raw_capacity = capacity
+            self.__raw_count = 0
+
+
+    def take_raw(self) -> bytes:
+        """Pack and return the batch collected so far, or None if it is empty."""
+        # Sequence numbers let a consumer tell a lost batch from a quiet sensor.
+        with self.__raw_lock:
+            if self.__raw_count == 0:
+                return None
+            RAW_HEADER.pack_into(self.__raw,0,self.__raw_sequence,self.__raw_time,self.__raw_count)
+            batch = bytes(memoryview(self.__raw)[:RAW_HEADER.size + self.__raw_count * RAW_SAMPLE.size])
+            self.__raw_sequence = (self.__raw_sequence + 1) & 0xffffffff
+            self.__raw_count = 0
+        return batch
+
+
+    def window(self) -> list:
+        """The samples in the averaging window as (timestamp, counts), oldest first."""
+        return list(self.__sample_array)
+
+
+    def restore(self, window: list, humidity: float, oldest: float) -> int:
+        """Seed the averaging window with samples since oldest, before the sensor starts. Returns the number kept."""
+        window = [(t, counts) for (t, counts) in window if t >= oldest]
+        if len(window) == 0:
+            return 0
+
+        self.__sample_array.extend(window)
+        while len(self.__sample_array) > self.__samples:
+            self.__sample_array.popleft()
+        self.__average()
+        self.__humidity = round(humidity * COUNTS_MAX / 100)
+        return len(self.__sample_array)
 
 
     def temperature(self,units: int) -> float:
         temp = None
-        if not self.__tempcounts is None:
+        tempcounts = self.__tempcounts
+        if not tempcounts is None:
+            (tempsum, samples) = tempcounts
             if units == UNITS_CELCIUS:
-                temp = -45.0 + (175 * (self.__tempcounts / 65535))
+                temp = counts_to_celsius(tempsum / samples)
             elif units == UNITS_FARENHEIT:
-                temp = -49.0 + (315 * (self.__tempcounts / 65535))
+                temp = -49.0 + (315 * (tempsum / samples / COUNTS_MAX))
         return temp
 
 
+    def open(self) -> int:
+        """Open the device and start periodic measurement. Blocks on the ioctl."""
+        fd = os.open(f'/dev/{self.__device}',os.O_RDONLY)
+        try:
+            if fcntl.ioctl(fd,SHT3X_MEASUREMENT_MODE,self.__mode) != 0:
+                raise Exception(f'device {self.__device} could not be set to measurement mode {self.__mode}')
+        except:
+            os.close(fd)
+            raise
+
+        logger.info(f'Started with temp sample size of {self.__samples}')
+        return fd
+
+
+    def close(self,fd: int):
+        os.close(fd)
+
+
+    def read(self,fd: int):
+        """Read one measurement from a readable fd and fold it into the average."""
+        data = os.read(fd,SAMPLE_SIZE)
+        if len(data) != SAMPLE_SIZE:
+            metrics.inc(metrics.SENSOR_SHORT_READS)
+            raise Exception(f'Incorrect amount of data returned. Read {len(data)}, expected {SAMPLE_SIZE}.')
+
+        self.sample(data)
+
+
+    def sample(self,data: bytes):
+        """Fold one raw measurement (temperature and humidity words with CRCs) into the average."""
+        now = time.time()
+        tcounts = (data[0] << 8) | data[1]
+        self.__sample_array.append((now, tcounts))
+        self.__tempsum += tcounts
+
+        while len(self.__sample_array) > self.__samples:
+            (_, _counts) = self.__sample_array.popleft()
+            self.__tempsum -= _counts
+
+        self.__tempcounts = (self.__tempsum, len(self.__sample_array))
+
+        hcounts = (data[3] << 8) | data[4]
+        self.__humidity = hcounts
+
+        if not self.__raw is None:
+            # A fault in the raw stream must not cost the control window.
+            try:
+                self.__raw_sample(now,tcounts,hcounts)
+            except Exception as ex:
+                metrics.inc(metrics.RAW_SAMPLES_DROPPED)
+                logger.error(ex)
+
+
+    def __raw_sample(self, now: float, tcounts: int, hcounts: int):
+        # Offsets run on the monotonic clock; wall time is only in the header.
+        elapsed = time.monotonic()
+        with self.__raw_lock:
+            if self.__raw_count == self.__raw_capacity:
+                metrics.inc(metrics.RAW_SAMPLES_DROPPED)
+                return
+            if self.__raw_count == 0:
+                self.__raw_time = now
+                self.__raw_start = elapsed
+            offset = RAW_HEADER.size + self.__raw_count * RAW_SAMPLE.size
+            RAW_SAMPLE.pack_into(self.__raw,offset,min(int((elapsed - self.__raw_start) * 1e6),0xffffffff),tcounts,hcounts)
+            self.__raw_count += 1
+
+
+    def __average(self):
+        # Recounted in full where the window is replaced rather than slid.
+        tempsum = 0
+        for (_, _counts) in self.__sample_array:
+            tempsum += _counts
+        self.__tempsum = tempsum
+        self.__tempcounts = (tempsum, len(self.__sample_array))
+
+
+    def reset(self):
+        self.__sample_array.clear()
+        self.__tempsum = 0
+        self.__tempcounts = None
+
+
     def __run(self):
         while not self.__event.is_set():
-            fd = None
             try:
-                fd = os.open(f'/dev/{self.__device}',os.O_RDONLY)
-                if fcntl.ioctl(fd,SHT3X_MEASUREMENT_MODE,self.__mode) != 0:
-                    raise Exception(f'device {self.__device} could not be set to measurement mode {self.__mode}')
+                fd = self.open()
             except Exception as ex:
+                metrics.inc(metrics.SENSOR_OPEN_ERRORS)
                 logger.critical(ex)
-                if not fd is None:
-                    os.close(fd)
-                sleep(1.0)
+                self.__event.wait(1.0)
                 continue
 
-            sample_array = collections.deque()
-
-            logger.info(f'Started with temp sample size of {self.__samples}')
-
             while not self.__event.is_set():
                 try:
-                    (rlist,_,_) = select.select([fd],[],[],3)
-                    if len(rlist) != 0:
-                        data = os.read(fd,6)
-                        if len(data) != 6:
-                            raise Exception(f'Incorrect amount of data returned. Read {len(data)}, expected 6.')
-                        else:
-                            tcounts = (data[0] << 8) | data[1]
-                            sample_array.append(tcounts)
-
-                            if len(sample_array) > self.__samples:
-                                sample_array.popleft()
-
-                            # if len(sample_array) == self.__samples:
-                            tcounts = 0
-                            for _counts in sample_array:
-                                tcounts += _counts
-                            tcounts /= len(sample_array)
-                            self.__tempcounts = tcounts
-
-                            self.__humidity = 100 * (((data[3] << 8) | data[4]) / 65535)
-
+                    (rlist,_,_) = select.select([fd,self.__wake[0]],[],[],READ_TIMEOUT)
+                    if self.__wake[0] in rlist:
+                        break
+                    elif len(rlist) != 0:
+                        self.read(fd)
                     else:
                         # Log the unexpected timeout waiting for data to read.
+                        metrics.inc(metrics.SENSOR_TIMEOUTS)
                         raise Exception('Unexpected timeout waiting for sensor data.')
 
                 except Exception as ex:
                     logger.critical(ex)
-                    sample_array.clear()
-                    self.__tempcounts = None
+                    self.reset()
                     break
 
-            os.close(fd)
+            self.close(fd)
@@ -0,0 +1,520 @@
+"""Long-running soak of the whole daemon against simulated devices.
+
+    python -m thermostat.soak [--hours 72] [--zones 1] [--report soak.json]
+
+Control, Settings, the Schedule and the Scheduler run unmodified. MQTT is an
+in-process broker stand-in installed in place of the client, and each zone's
+sensor, relays and fan are simulated around a simple thermal model. Time is
+accelerated: the Scheduler runs on a simulated clock and everything due in a
+simulated second (ticks, snapshots, debounced pushes, schedule transitions)
+runs before the next one starts, as fast as it will go. Realistic action
+traffic arrives on <topic>/action and the broker connection drops and comes
+back regularly, so backfill is exercised too.
+
+RSS, thread count, open file descriptors, publish rate, tick duration and
+tick jitter (how late in its simulated second a tick started) are sampled
+throughout. The run fails if any of them drift between the start (after a
+warm-up) and the end.
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import queue
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from project_common.logger import logger
+from project_common.mqtt import Mqtt, mqtt
+
+from . import control
+from . import memory
+from . import relays
+from . import schedule
+from . import sht3x
+from .config import Config
+from .control import Control
+from .publisher import Publisher
+from .scheduler import Scheduler
+from .settings import Settings
+
+
+SAMPLE_MINUTES = 10
+WARMUP = 0.25
+COMMANDS_PER_HOUR = 60
+# The broker connection is lost for OUTAGE seconds of every RECONNECT_PERIOD.
+RECONNECT_PERIOD = 1200
+OUTAGE = 120
+
+# Allowed drift from the first to the last window.
+RSS_GROWTH_LIMIT = 4 * 1024 * 1024
+THREAD_GROWTH_LIMIT = 0
+FD_GROWTH_LIMIT = 0
+PUBLISH_RATE_LIMIT = 2.0
+TICK_GROWTH_LIMIT = 2.0
+
+# Heat and cool relays stay locked out this long after switching off.
+LOCKOUT = 300
+LOCKOUT_RELAYS = (relays.RELAY_HEAT, relays.RELAY_COOL)
+
+
+class PublishInfo():
+    def __init__(self, rc: int):
+        self.rc = rc
+
+
+class LocalBroker():
+    """Stands in for project_common.mqtt.Mqtt with in-process delivery.
+
+    Messages to subscribers are delivered on a separate 'broker' thread, as
+    the real client delivers them on its network thread.
+    """
+    def __init__(self):
+        self.__on_connect = []
+        self.__on_disconnect = []
+        self.__callbacks = {}
+        self.__lock = threading.Lock()
+        self.__connected = False
+        self.__inbox = queue.Queue()
+        self.__publishes = collections.Counter()
+        self.__thread = threading.Thread(target=self.__run,name='broker')
+        self.__thread.start()
+
+
+    def register_on_connect(self, callback):
+        self.__on_connect.append(callback)
+
+
+    def register_on_disconnect(self, callback):
+        self.__on_disconnect.append(callback)
+
+
+    def will_set(self, topic: str, payload=None, qos: int = 0, retain: bool = False, **kwargs):
+        pass
+
+
+    def connect(self):
+        with self.__lock:
+            self.__connected = True
+        for callback in self.__on_connect:
+            callback(self,None,{},mqtt.client.CONNACK_ACCEPTED)
+
+
+    def drop(self):
+        """Lose the connection, as a network failure would."""
+        with self.__lock:
+            self.__connected = False
+        for callback in self.__on_disconnect:
+            callback(self,None,mqtt.client.MQTT_ERR_CONN_LOST)
+
+
+    def connected(self) -> bool:
+        with self.__lock:
+            return self.__connected
+
+
+    def disconnect(self):
+        with self.__lock:
+            self.__connected = False
+        for callback in self.__on_disconnect:
+            callback(self,None,mqtt.client.MQTT_ERR_SUCCESS)
+        self.__inbox.put(None)
+        self.__thread.join()
+
+
+    def subscribe(self, topic: str, qos: int = 0, **kwargs):
+        pass
+
+
+    def message_callback_add(self, sub: str, callback):
+        with self.__lock:
+            self.__callbacks[sub] = callback
+
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False, **kwargs) -> PublishInfo:
+        with self.__lock:
+            if not self.__connected:
+                return PublishInfo(mqtt.client.MQTT_ERR_NO_CONN)
+            self.__publishes[topic] += 1
+        return PublishInfo(mqtt.client.MQTT_ERR_SUCCESS)
+
+
+    def publishes(self) -> int:
+        with self.__lock:
+            return sum(self.__publishes.values())
+
+
+    def inject(self, topic: str, payload: bytes):
+        """Deliver a message to the daemon as if a client had published it."""
+        message = mqtt.client.MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        self.__inbox.put(message)
+
+
+    def drain(self):
+        self.__inbox.join()
+
+
+    def __run(self):
+        while True:
+            message = self.__inbox.get()
+            try:
+                if message is None:
+                    return
+                with self.__lock:
+                    callbacks = [callback for (sub, callback) in self.__callbacks.items() if mqtt.client.topic_matches_sub(sub,message.topic)]
+                for callback in callbacks:
+                    try:
+                        callback(self,None,message)
+                    except Exception as ex:
+                        logger.error(ex)
+            finally:
+                self.__inbox.task_done()
+
+
+class SimClock():
+    """Whole simulated seconds since start, for the Scheduler and the simulated devices."""
+    def __init__(self, start: float):
+        self.now = 0
+        # perf_counter() when the current simulated second began.
+        self.began = 0.0
+        self.__start = start
+
+
+    def monotonic(self) -> float:
+        return float(self.now)
+
+
+    def time(self) -> float:
+        return self.__start + self.now
+
+
+class TimedControl(Control):
+    """Control with each tick's lateness into its simulated second and duration recorded."""
+    def __init__(self, config: Config, clock: SimClock, ticks: list, **devices):
+        super().__init__(config,**devices)
+        self.__clock = clock
+        self.__ticks = ticks
+
+
+    def tick(self):
+        time_in = time.perf_counter()
+        super().tick()
+        self.__ticks.append((time_in - self.__clock.began, time.perf_counter() - time_in))
+
+
+class SimRelays():
+    def __init__(self, clock: SimClock):
+        self.__clock = clock
+        self.__on = {relays.RELAY_FAN: False, relays.RELAY_HEAT: False, relays.RELAY_COOL: False}
+        self.__locked_until = {relays.RELAY_FAN: 0, relays.RELAY_HEAT: 0, relays.RELAY_COOL: 0}
+
+
+    def close(self, timeout: float = None):
+        pass
+
+
+    def is_on(self, relay: int) -> bool:
+        return self.__on[relay]
+
+
+    def get_status(self) -> bytes:
+        status = bytearray(4)
+        for relay in self.__on:
+            status[relay] = self.__relay_status(relay)
+        return bytes(status)
+
+
+    def reset_mcusr(self) -> int:
+        return 0
+
+
+    def relay_on(self, relay: int) -> int:
+        if self.__clock.now >= self.__locked_until[relay]:
+            self.__on[relay] = True
+        return self.__relay_status(relay)
+
+
+    def relay_off(self, relay: int) -> int:
+        if self.__on[relay]:
+            self.__on[relay] = False
+            if relay in LOCKOUT_RELAYS:
+                self.__locked_until[relay] = self.__clock.now + LOCKOUT
+        return self.__relay_status(relay)
+
+
+    def relay_all_off(self, timeout: float = None) -> bytes:
+        for relay in self.__on:
+            self.__on[relay] = False
+        return self.get_status()
+
+
+    def __relay_status(self, relay: int) -> int:
+        if self.__on[relay]:
+            return relays.RELAY_STATUS_ON
+        if self.__clock.now < self.__locked_until[relay]:
+            return relays.RELAY_STATUS_LOCKED
+        return relays.RELAY_STATUS_OFF
+
+
+class SimSht3x():
+    """A room that drifts toward a slowly swinging outdoor temperature and responds to the relays."""
+    def __init__(self, clock: SimClock, relay: SimRelays, rng: random.Random):
+        self.__clock = clock
+        self.__relay = relay
+        self.__rng = rng
+        self.__temp = 22.0
+
+
+    def start(self):
+        pass
+
+
+    def stop(self, timeout: float = None):
+        pass
+
+
+    def set_samples(self, samples: int):
+        pass
+
+
+    def advance(self):
+        outdoor = 15.0 + 12.0 * ((self.__clock.now % 86400) / 43200.0 - 1.0) ** 2
+        self.__temp += (outdoor - self.__temp) * 0.0002
+        if self.__relay.is_on(relays.RELAY_HEAT):
+            self.__temp += 0.004
+        if self.__relay.is_on(relays.RELAY_COOL):
+            self.__temp -= 0.004
+
+
+    def counts(self) -> tuple:
+        return (sht3x.celsius_to_counts(self.__temp + self.__rng.gauss(0.0,0.01)), 1)
+
+
+    def humidity(self) -> float:
+        return 45.0
+
+
+    def window(self) -> list:
+        return []
+
+
+    def restore(self, window: list, humidity: float, oldest: float) -> int:
+        return 0
+
+
+class SimFan():
+    def on(self):
+        pass
+
+
+    def off(self, timeout: float = None):
+        pass
+
+
+    def set_pwm_duty(self, duty: int):
+        pass
+
+
+    def get_rpm(self) -> int:
+        return 1800
+
+
+def open_fds() -> int:
+    return len(os.listdir('/proc/self/fd'))
+
+
+def random_command(rng: random.Random):
+    heat = round(rng.uniform(18.0,22.0),1)
+    choices = [
+        {Settings.CMD: Settings.CMD_GET_SETTINGS},
+        {Settings.CMD: Settings.CMD_GET_FAN},
+        {Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: {'mode': rng.choice([control.MODE_AUTO, control.MODE_HEAT, control.MODE_COOL]), control.MODE_HEAT: heat, control.MODE_COOL: heat + rng.uniform(1.0,4.0)}},
+        {Settings.CMD: Settings.CMD_PUT_FAN, Settings.RESULT: {control.FAN: rng.choice([control.MODE_AUTO, control.MODE_ON])}},
+        {Settings.CMD: Settings.CMD_GET_SCHEDULE},
+        [{Settings.CMD: Settings.CMD_GET_SETTINGS}, {Settings.CMD: Settings.CMD_GET_FAN}],
+        {Settings.CMD: Settings.CMD_PUT_SETTINGS, Settings.RESULT: {'mode': 'bogus'}},
+    ]
+    command = rng.choice(choices)
+    if isinstance(command,dict) and rng.random() < 0.5:
+        command[Settings.ID] = rng.randrange(1 << 16)
+    return command
+
+
+def p95(values: list) -> float:
+    return sorted(values)[int(len(values) * 0.95)] if len(values) != 0 else 0.0
+
+
+def weekly_schedule(rng: random.Random) -> dict:
+    """A weekly schedule with a transition every few hours, every day."""
+    days = list(schedule.DAY_NAMES)
+    events = []
+    for hour in range(0,24,3):
+        heat = round(rng.uniform(18.0,22.0),1)
+        events.append({schedule.DAYS: days, schedule.TIME: f'{hour:02d}:00', 'mode': control.MODE_AUTO, control.MODE_HEAT: heat, control.MODE_COOL: heat + 3.0})
+    return {schedule.ENABLED: True, schedule.WEEKLY: events}
+
+
+def sample(broker: LocalBroker, ticks: list) -> dict:
+    return {
+        'rss': memory.rss(),
+        'threads': threading.active_count(),
+        'fds': open_fds(),
+        'publishes': broker.publishes(),
+        'tick_p95': p95([duration for (_, duration) in ticks]),
+        'tick_jitter_p95': p95([late for (late, _) in ticks]),
+    }
+
+
+def check(samples: list, minutes: int, target: int = None) -> list:
+    """Compare the first and last window after warm-up, and RSS against target bytes; returns the failures."""
+    start = int(len(samples) * WARMUP)
+    window = max((len(samples) - start) // 4,1)
+    first = samples[start:start + window]
+    last = samples[-window:]
+    if len(first) < 2 or len(last) < 2:
+        return ['Run too short to judge drift.']
+
+    failures = []
+
+    peak = max(s['rss'] for s in samples)
+    if not target is None and peak > target:
+        failures.append(f'RSS peaked at {peak / memory.MIB:.1f}MiB, over the {target / memory.MIB:.1f}MiB target')
+
+    growth = max(s['rss'] for s in last) - max(s['rss'] for s in first)
+    if growth > RSS_GROWTH_LIMIT:
+        failures.append(f'RSS grew by {growth / 1024:.0f}KiB')
+
+    growth = max(s['threads'] for s in last) - max(s['threads'] for s in first)
+    if growth > THREAD_GROWTH_LIMIT:
+        failures.append(f'Thread count grew by {growth}')
+
+    growth = max(s['fds'] for s in last) - max(s['fds'] for s in first)
+    if growth > FD_GROWTH_LIMIT:
+        failures.append(f'Open file descriptors grew by {growth}')
+
+    def rate(window: list) -> float:
+        return (window[-1]['publishes'] - window[0]['publishes']) / (len(window) - 1) / minutes * 60
+
+    (rate_first, rate_last) = (rate(first), rate(last))
+    if rate_first > 0 and not 1 / PUBLISH_RATE_LIMIT <= rate_last / rate_first <= PUBLISH_RATE_LIMIT:
+        failures.append(f'Publish rate moved from {rate_first:.0f}/h to {rate_last:.0f}/h')
+
+    for (field, name) in (('tick_p95', 'Tick p95'), ('tick_jitter_p95', 'Tick jitter p95')):
+        tick_first = statistics.median(s[field] for s in first)
+        tick_last = statistics.median(s[field] for s in last)
+        if tick_first > 0 and tick_last / tick_first > TICK_GROWTH_LIMIT:
+            failures.append(f'{name} grew from {tick_first * 1e6:.0f}us to {tick_last * 1e6:.0f}us')
+
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m thermostat.soak')
+    parser.add_argument('--hours',type=float,default=72,help='simulated hours to run')
+    parser.add_argument('--zones',type=int,default=1,help='number of zones')
+    parser.add_argument('--seed',type=int,default=1,help='seed for the simulated traffic')
+    parser.add_argument('--report',help='write the samples and verdict to this JSON file')
+    parser.add_argument('--rss-target',type=float,help='run in low-memory mode and fail above this RSS, in MiB')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.ERROR)
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        thermostat = {
+            'sht3x-device': 'soak',
+            'i2c-device': 'soak',
+            'relay-address': 0x10,
+            'fan-pwr-gpio': 'soak',
+            'settings-file': os.path.join(directory,'settings.json'),
+            'settings-debounce': 0.5,
+            # Commands arrive thousands of times faster than real time.
+            'action-rate': 0,
+        }
+        if args.zones > 1:
+            thermostat['zones'] = {f'zone{i}': {'sht3x-device': f'soak{i}', 'relay-address': 0x10 + i, 'settings-file': os.path.join(directory,f'settings{i}.json')} for i in range(args.zones)}
+        if not args.rss_target is None:
+            thermostat['rss-target'] = args.rss_target
+        Config({'thermostat': thermostat})
+
+        if Config.instance().low_memory():
+            memory.limit_stacks()
+
+        broker = LocalBroker()
+        # Every module reaches the client through Mqtt.instance().
+        Mqtt.instance = staticmethod(lambda: broker)
+
+        clock = SimClock(time.time())
+        ticks = []
+        Publisher()
+        Scheduler(clock=clock)
+        sensors = []
+        for zone in Config.instance().zones():
+            with open(zone.schedule_file(),'w') as f:
+                json.dump(weekly_schedule(rng),f)
+            relay = SimRelays(clock)
+            sensors.append(SimSht3x(clock,relay,rng))
+            TimedControl(zone,clock,ticks,sht=sensors[-1],relay=relay,board_fan=SimFan())
+            Settings(zone)
+        for ctl in Control.instances():
+            ctl.open()
+        broker.connect()
+        for ctl in Control.instances():
+            ctl.start()
+
+        topics = [f'{zone.topic()}/{Settings.ACTION}' for zone in Config.instance().zones()]
+        sample_seconds = SAMPLE_MINUTES * 60
+        samples = []
+        time_in = time.monotonic()
+
+        try:
+            for second in range(int(args.hours * 3600)):
+                clock.now = second
+                clock.began = time.perf_counter()
+                for sensor in sensors:
+                    sensor.advance()
+                Scheduler.instance().run_due()
+
+                if second >= RECONNECT_PERIOD and second % RECONNECT_PERIOD == 0:
+                    broker.drop()
+                elif second % RECONNECT_PERIOD == OUTAGE and not broker.connected():
+                    broker.connect()
+
+                if broker.connected() and rng.random() < COMMANDS_PER_HOUR / 3600:
+                    broker.inject(rng.choice(topics),json.dumps(random_command(rng)).encode())
+
+                if second % sample_seconds == 0:
+                    broker.drain()
+                    samples.append(sample(broker,ticks))
+                    ticks.clear()
+        finally:
+            for settings in Settings.instances():
+                settings.stop()
+            Scheduler.instance().stop()
+            for ctl in Control.instances():
+                ctl.stop()
+            Publisher.instance().stop()
+            broker.disconnect()
+
+    failures = check(samples,SAMPLE_MINUTES,Config.instance().rss_target())
+
+    print(f'Simulated {args.hours}h across {args.zones} zone(s) in {time.monotonic() - time_in:.1f}s')
+    print(f'RSS {samples[0]["rss"] // 1024}KiB -> {samples[-1]["rss"] // 1024}KiB, threads {samples[0]["threads"]} -> {samples[-1]["threads"]}, fds {samples[0]["fds"]} -> {samples[-1]["fds"]}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+
+    if not args.report is None:
+        with open(args.report,'w') as f:
+            json.dump({'hours': args.hours, 'zones': args.zones, 'stack_size': threading.stack_size(), 'samples': samples, 'failures': failures},f,indent=2)
+
+    return 0 if len(failures) == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
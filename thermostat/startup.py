@@ -0,0 +1,115 @@
+import contextlib
+import importlib
+import os
+import threading
+import time
+
+from project_common.logger import logger
+
+
+# (name, seconds) for each timed step while profiling, otherwise None.
+_steps = None
+
+
+def enable():
+    """Record the time of every step from now on, for report()."""
+    global _steps
+    _steps = []
+
+
+@contextlib.contextmanager
+def step(name: str):
+    """Time the enclosed block as one startup step when profiling is enabled."""
+    if _steps is None:
+        yield
+        return
+
+    time_in = time.perf_counter()
+    try:
+        yield
+    finally:
+        _steps.append((name, time.perf_counter() - time_in))
+
+
+def load(package: str, names: tuple):
+    """Import each module as its own step, so one never hides in another's time."""
+    for name in names:
+        with step(f'import {name}'):
+            importlib.import_module(name,package)
+
+
+def since_exec() -> float:
+    """Seconds since the process was started, interpreter startup included, or None where it is not known."""
+    try:
+        with open('/proc/self/stat','r') as f:
+            # The command name can hold spaces, so count fields from its closing parenthesis.
+            fields = f.read().rpartition(')')[2].split()
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def since_boot() -> float:
+    try:
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    except (OSError, AttributeError):
+        return None
+
+
+def report():
+    """Log the recorded steps, slowest first. Steps on other threads overlap the rest."""
+    if _steps is None:
+        return
+
+    process = since_exec()
+    logger.info(f'Startup profile: {len(_steps)} steps' + ('' if process is None else f', started in {process:.3f}s'))
+    for (name, seconds) in sorted(_steps,key=lambda s: s[1],reverse=True):
+        logger.info(f'  {seconds * 1000:8.1f}ms  {name}')
+
+
+def log_first_status(publisher, topics: list):
+    """Log how long after the process and the system started the first status went to the broker."""
+    from .control import OOS
+
+    topics = frozenset(topics)
+    done = threading.Event()
+
+    def on_sent(topic: str, payload):
+        if done.is_set() or not topic in topics or payload == OOS:
+            return
+        done.set()
+        (process, boot) = (since_exec(), since_boot())
+        if process is None:
+            logger.info('First status published.')
+        else:
+            logger.info(f'First status published {process:.3f}s after start, {boot:.1f}s after boot.')
+
+    publisher.register_on_sent(on_sent)
+
+
+class Background():
+    def __init__(self, name: str, target):
+        """Run target() on its own thread so it overlaps whatever starts next.
+
+        join() waits for it and raises what target raised, so a failure
+        surfaces where it would have if target had been called in line.
+        """
+        self.__target = target
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run,name=name)
+        self.__thread.start()
+
+
+    def join(self):
+        self.__thread.join()
+        if not self.__error is None:
+            raise self.__error
+
+
+    def __run(self):
+        with step(self.__thread.name):
+            try:
+                self.__target()
+            except Exception as ex:
+                self.__error = ex